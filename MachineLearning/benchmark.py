@@ -0,0 +1,474 @@
+import sys
+import getopt
+import csv
+import json
+import os
+import platform
+import resource
+import shlex
+import time
+import tracemalloc
+import multiprocessing
+import numpy
+import classifier
+import preprocessor
+import wrapper
+from concurrent.futures import ProcessPoolExecutor
+from sklearn import tree
+
+
+# data sets used by the benchmarks along with the options needed to load them
+DATA_SETS = {
+    "iris": dict(file_path="iris.csv", mapped=[4]),
+    "breast_cancer": dict(file_path="breast_cancer.csv", ignore=[0]),
+    "chess": dict(file_path="chess.csv", mapped=[0, 2, 4, 6]),
+    "car": dict(file_path="car.csv", mapped=[0, 1, 2, 3, 4, 5, 6]),
+    "credit": dict(file_path="credit.csv", mapped=[0, 3, 4, 5, 6, 8, 9, 11, 12, 15],
+                   bins={2: 5, 3: 5, 7: 5, 10: 5, 13: 5, 14: 5}),
+    "diabetes": dict(file_path="diabetes.csv", mapped=[8], norm=True),
+}
+
+
+def load_data_set(name, split=70):
+    """
+    Loads one of the benchmark data sets with a fixed shuffle so every run sees the same split
+    :param name:
+    :param split:
+    :return:
+    """
+    options = dict(ordered={}, ignore=[], mapped=[], bins={}, split=split, seed=0)
+    options.update(DATA_SETS[name])
+    return preprocessor.DataSet(**options)
+
+
+def time_predict(net, attributes):
+    start = time.perf_counter()
+    predictions = net.predict(attributes)
+    return predictions, time.perf_counter() - start
+
+
+def bench_knn_index(names, k):
+    """
+    Compares the query time of the brute force KNearestNeighbor scan against the KDTree index
+    :param names:
+    :param k:
+    :return:
+    """
+    print("data set".ljust(16), "rows".rjust(8), "brute (s)".rjust(12), "kdtree (s)".rjust(12),
+          "build (s)".rjust(12), "speedup".rjust(10), "  same")
+    for name in names:
+        data = load_data_set(name)
+
+        brute = classifier.KNearestNeighbor(k=k)
+        brute.train(data.train_attributes, data.train_targets, data.mapped_columns)
+        brute_predictions, brute_time = time_predict(brute, data.test_attributes)
+
+        start = time.perf_counter()
+        indexed = classifier.KNearestNeighbor(k=k, index="kdtree")
+        indexed.train(data.train_attributes, data.train_targets, data.mapped_columns)
+        build_time = time.perf_counter() - start
+        indexed_predictions, indexed_time = time_predict(indexed, data.test_attributes)
+
+        same = list(brute_predictions) == list(indexed_predictions)
+        print(name.ljust(16), str(len(data.data_array)).rjust(8), ("%.3f" % brute_time).rjust(12),
+              ("%.3f" % indexed_time).rjust(12), ("%.3f" % build_time).rjust(12),
+              ("%.1fx" % (brute_time / indexed_time)).rjust(10), " ", same)
+
+
+def bench_id3_predict(names, repeat):
+    """
+    Compares walking the ID3Node objects one row at a time against the compiled batch predict
+    :param names:
+    :param repeat: number of copies of the test set to predict
+    :return:
+    """
+    print("data set".ljust(16), "rows".rjust(8), "nodes (s)".rjust(12), "compiled (s)".rjust(12),
+          "speedup".rjust(10), "  same")
+    for name in names:
+        data = load_data_set(name)
+        net = classifier.ID3()
+        net.train(data.train_attributes, data.train_targets)
+        attributes = numpy.vstack([data.test_attributes] * repeat)
+
+        start = time.perf_counter()
+        node_predictions = [net.traverse_tree(row, net.root) for row in attributes]
+        node_time = time.perf_counter() - start
+        compiled_predictions, compiled_time = time_predict(net, attributes)
+
+        same = node_predictions == compiled_predictions
+        print(name.ljust(16), str(len(attributes)).rjust(8), ("%.3f" % node_time).rjust(12),
+              ("%.3f" % compiled_time).rjust(12), ("%.1fx" % (node_time / compiled_time)).rjust(10), " ", same)
+
+
+def bench_forest(names, num_trees, jobs):
+    """
+    Compares the wall time and accuracy of RandomForest against a single ID3 tree and the sklearn
+    decision tree used by DecisionTree_alt
+    :param names:
+    :param num_trees:
+    :param jobs:
+    :return:
+    """
+    print("data set".ljust(16), "classifier".ljust(18), "train (s)".rjust(12), "predict (s)".rjust(12),
+          "accuracy".rjust(10))
+    for name in names:
+        data = load_data_set(name)
+        nets = [("ID3", classifier.ID3()),
+                ("RandomForest", classifier.RandomForest(num_trees=num_trees, n_jobs=jobs, seed=0)),
+                ("DecisionTree_alt", tree.DecisionTreeClassifier(random_state=0))]
+        for net_name, net in nets:
+            start = time.perf_counter()
+            if net_name == "DecisionTree_alt":
+                net.fit(data.train_attributes, data.train_targets.ravel())
+            else:
+                net.train(data.train_attributes, data.train_targets)
+            train_time = time.perf_counter() - start
+            predictions, predict_time = time_predict(net, data.test_attributes)
+            print(name.ljust(16), net_name.ljust(18), ("%.3f" % train_time).rjust(12),
+                  ("%.3f" % predict_time).rjust(12),
+                  ("%.2f" % wrapper.accuracy(predictions, data.test_targets)).rjust(10))
+
+
+def bench_perceptron_alloc(names, batch_sizes, scales, limit=16 * 1024):
+    """
+    Uses tracemalloc to check that Perceptron training doesn't allocate memory once it has warmed up.
+    Memory is traced from the end of epoch 2 to the end of epoch 7, and the highest amount allocated
+    above the starting point must stay under limit bytes however large the training set is.
+    :param names:
+    :param batch_sizes:
+    :param scales: how many copies of the training set to train on
+    :param limit:
+    :return:
+    """
+    print("data set".ljust(16), "rows".rjust(8), "batch".rjust(6), "peak (bytes)".rjust(14),
+          "left (bytes)".rjust(14), "  ok")
+    all_ok = True
+    for name in names:
+        data = load_data_set(name)
+        for scale in scales:
+            attributes = numpy.vstack([data.train_attributes] * scale)
+            targets = numpy.vstack([data.train_targets] * scale)
+            for batch_size in batch_sizes:
+                traced = {}
+
+                def trace_epoch(epoch, metrics):
+                    if epoch == 2:
+                        tracemalloc.start()
+                        traced["start"] = tracemalloc.get_traced_memory()[0]
+                    elif epoch == 7:
+                        current, peak = tracemalloc.get_traced_memory()
+                        tracemalloc.stop()
+                        traced["peak"] = peak - traced["start"]
+                        traced["left"] = current - traced["start"]
+
+                net = classifier.Perceptron(.1, [4, 4], batch_size=batch_size, max_epochs=8, validation=20,
+                                            callback=trace_epoch)
+                net.train(attributes, targets)
+
+                ok = traced["peak"] < limit
+                all_ok = all_ok and ok
+                print(name.ljust(16), str(len(attributes)).rjust(8), str(batch_size).rjust(6),
+                      str(traced["peak"]).rjust(14), str(traced["left"]).rjust(14), " ", ok)
+    return all_ok
+
+
+# classifiers which take too long on the largest scaled up data sets to run by default
+SLOW_CLASSIFIERS = ["KNearestNeighbors", "Perceptron"]
+
+# changes smaller than these are treated as noise when comparing against the baseline
+MIN_TIME_CHANGE = .05
+MIN_RSS_CHANGE = 5
+MIN_ACCURACY_CHANGE = 1
+
+
+def read_recipes(file_path):
+    """
+    Returns the command lines given in the recipes file, skipping the headings
+    :param file_path:
+    :return:
+    """
+    with open(file_path, "rt") as recipe_file:
+        return [line.strip() for line in recipe_file if line.strip().startswith("--")]
+
+
+def scale_data_set(options, scale, data_dir, seed):
+    """
+    Writes a synthetic version of the recipe's data set with scale times as many rows. The
+    original rows are split into training and test rows first, and each part is scaled up from
+    its own rows only, so no test row is a copy of a training row. Rows are drawn with
+    replacement and the numeric attributes are jittered by 5% of their standard deviation, so
+    the copies aren't exact duplicates. Mapped, ordered and target columns are copied as they
+    are. The files are only written once for each data set, target, split, seed and scale.
+    :param options: the recipe's options from wrapper.parse_args
+    :param scale:
+    :param data_dir:
+    :param seed:
+    :return: paths to the training and test csv files, or the original file and None when scale is 1
+    """
+    if scale == 1:
+        return options["data_set"], None
+    name = os.path.splitext(os.path.basename(options["data_set"]))[0]
+    prefix = os.path.join(data_dir, "%s_target%d_split%d_seed%d_x%d" % (name, options["target"], options["split"],
+                                                                          seed, scale))
+    paths = (prefix + "_train.csv", prefix + "_test.csv")
+    if all(os.path.exists(path) for path in paths):
+        return paths
+
+    with open(options["data_set"], "rt") as csv_file:
+        columns = [numpy.array(column) for column in zip(*csv.reader(csv_file, delimiter=","))]
+    num_rows = len(columns[0])
+    target = options["target"] if options["target"] >= 0 else len(columns) - 1
+    categorical = set(options["mapped"]) | set(options["ordered"]) | {target}
+
+    rng = numpy.random.default_rng(seed)
+    order = rng.permutation(num_rows)
+    num_train = num_rows * options["split"] // 100
+    os.makedirs(data_dir, exist_ok=True)
+    for path, originals in zip(paths, (order[:num_train], order[num_train:])):
+        rows = originals[rng.integers(0, len(originals), len(originals) * scale)]
+        scaled = []
+        for idx, column in enumerate(columns):
+            missing = column == "?"
+            values = None
+            if idx not in categorical:
+                try:
+                    values = numpy.where(missing, "nan", column).astype(float)
+                except ValueError:
+                    pass
+            if values is None or numpy.isnan(values).all():
+                scaled.append(column[rows])
+                continue
+            jittered = values[rows] + rng.normal(0, .05 * numpy.nanstd(values), len(rows))
+            scaled.append(numpy.where(missing[rows], "?", numpy.char.mod("%.6g", jittered)))
+
+        temp_path = path + ".tmp" + str(os.getpid())
+        with open(temp_path, "wt", newline="") as csv_file:
+            csv.writer(csv_file).writerows(zip(*[column.tolist() for column in scaled]))
+        os.replace(temp_path, path)
+    return paths
+
+
+def run_recipe(recipe, class_name, data_path, test_path, epochs, seed):
+    """
+    Loads, trains and tests one classifier on one recipe's data set. Runs in a fresh process so
+    the peak RSS belongs to this run alone.
+    :param recipe:
+    :param class_name:
+    :param data_path:
+    :param test_path: csv file of the test rows, which are prepared the same way as the rows of
+                      data_path. When None, data_path is split into training and test rows.
+    :param epochs:
+    :param seed:
+    :return: map of the measurements
+    """
+    options = wrapper.parse_args(["wrapper.py"] + shlex.split(recipe) +
+                                 ["--seed=" + str(seed), "--epochs=" + str(epochs)])
+    options["data_set"] = data_path
+    settings = dict(options["settings"], jobs=1)
+
+    start = time.perf_counter()
+    if test_path is None:
+        data = wrapper.load_data_set(options)
+        test_attributes, test_targets = data.test_attributes, data.test_targets
+    else:
+        data = wrapper.load_data_set(options, split=100)
+        with open(test_path, "rt", newline="") as csv_file:
+            rows = [row for row in csv.reader(csv_file) if row]
+        test_attributes, test_targets = data.row_transform().transform(rows)
+    load_time = time.perf_counter() - start
+
+    net = wrapper.make_classifier(class_name, settings)
+    start = time.perf_counter()
+    wrapper.train(net, data.train_attributes, data.train_targets, data.mapped_columns)
+    train_time = time.perf_counter() - start
+
+    predictions, predict_time = time_predict(net, test_attributes)
+    num_rows = len(data.data_array) + (0 if test_path is None else len(test_attributes))
+    return dict(rows=num_rows, load_s=load_time, train_s=train_time, predict_s=predict_time,
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                accuracy=wrapper.accuracy(predictions, test_targets))
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Returns a description of every measurement which got worse than the baseline: times or peak
+    RSS more than tolerance (a fraction) higher, or accuracy more than a point lower
+    :param results:
+    :param baseline:
+    :param tolerance:
+    :return:
+    """
+    base = {(result["recipe"], result["classifier"], result["scale"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = base.get((result["recipe"], result["classifier"], result["scale"]))
+        if old is None or "error" in old or "error" in result or "skipped" in old or "skipped" in result:
+            continue
+        name = "%s %s x%d" % (result["classifier"], result["recipe"], result["scale"])
+        for field, min_change in (("load_s", MIN_TIME_CHANGE), ("train_s", MIN_TIME_CHANGE),
+                                  ("predict_s", MIN_TIME_CHANGE), ("peak_rss_mb", MIN_RSS_CHANGE)):
+            if result[field] > old[field] * (1 + tolerance) and result[field] - old[field] > min_change:
+                regressions.append("%s: %s %.3f -> %.3f" % (name, field, old[field], result[field]))
+        if result["accuracy"] < old["accuracy"] - MIN_ACCURACY_CHANGE:
+            regressions.append("%s: accuracy %.2f -> %.2f" % (name, old["accuracy"], result["accuracy"]))
+    return regressions
+
+
+def bench_suite(recipe_file, names, class_names, scales, epochs, max_rows, seed, data_dir, output, baseline, tolerance):
+    """
+    Replays every recipe in the recipes file with every classifier, on the original data set and on
+    synthetic versions scaled up to more rows. Load, train and predict time, peak RSS and accuracy
+    are written to the output json file, and compared against the baseline file if one is given.
+    Each run happens in its own process, one at a time.
+    :param recipe_file:
+    :param names: data set names to run, None for all
+    :param class_names:
+    :param scales:
+    :param epochs: maximum epochs for the Perceptron
+    :param max_rows: runs of the slow classifiers on more rows than this are skipped
+    :param seed:
+    :param data_dir: directory the scaled up data sets are written to
+    :param output:
+    :param baseline:
+    :param tolerance:
+    :return: True if nothing regressed
+    """
+    print("recipe".ljust(24), "classifier".ljust(22), "scale".rjust(6), "rows".rjust(9), "load (s)".rjust(9),
+          "train (s)".rjust(10), "predict (s)".rjust(12), "rss (MB)".rjust(9), "accuracy".rjust(9))
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for number, recipe in enumerate(read_recipes(recipe_file)):
+        options = wrapper.parse_args(["wrapper.py"] + shlex.split(recipe))
+        name = os.path.splitext(os.path.basename(options["data_set"]))[0]
+        if names is not None and name not in names:
+            continue
+        for scale in scales:
+            data_path, test_path = scale_data_set(options, scale, data_dir, seed)
+            for class_name in class_names:
+                result = dict(recipe=recipe, data_set=name, classifier=class_name, scale=scale)
+                num_rows = 0
+                for path in (data_path, test_path):
+                    if path is not None:
+                        with open(path, "rb") as data_file:
+                            num_rows += sum(1 for _ in data_file)
+                if class_name in SLOW_CLASSIFIERS and num_rows > max_rows:
+                    result["skipped"] = "more than %d rows" % max_rows
+                else:
+                    with ProcessPoolExecutor(1, mp_context=context) as executor:
+                        try:
+                            result.update(executor.submit(run_recipe, recipe, class_name, data_path, test_path,
+                                                          epochs, seed).result())
+                        except Exception as error:
+                            result["error"] = repr(error)
+                results.append(result)
+
+                label = (name + " #" + str(number + 1)).ljust(24) + " " + class_name.ljust(22) + " " + \
+                    ("x" + str(scale)).rjust(6)
+                if "skipped" in result or "error" in result:
+                    print(label, " ", result.get("skipped", result.get("error")))
+                else:
+                    print(label, str(result["rows"]).rjust(9), ("%.3f" % result["load_s"]).rjust(9),
+                          ("%.3f" % result["train_s"]).rjust(10), ("%.3f" % result["predict_s"]).rjust(12),
+                          ("%.1f" % result["peak_rss_mb"]).rjust(9), ("%.2f" % result["accuracy"]).rjust(9))
+
+    with open(output, "wt") as output_file:
+        json.dump(dict(seed=seed, epochs=epochs, scales=scales, python=platform.python_version(),
+                       numpy=numpy.__version__, machine=platform.platform(), results=results), output_file, indent=1)
+    print("Results written to", output)
+
+    if baseline is None:
+        return True
+    with open(baseline, "rt") as baseline_file:
+        regressions = compare_to_baseline(results, json.load(baseline_file), tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if not regressions:
+        print("No regressions against", baseline)
+    return not regressions
+
+
+def main(argv):
+    usage = "\tusage: --bench=[knn_index|id3_predict|forest|perceptron_alloc|suite] --datasets=[name1,name2,etc] \
+            --k=[neighbors] --repeat=[copies_of_test_set] --trees=[num_trees] --jobs=[num_processes] \
+            suite options: --recipes=[file] --classifiers=[name1,name2,etc] --scales=[1,10,100] --epochs=[max_epochs] \
+            --max-rows=[rows] --seed=[int] --data-dir=[directory] --output=[json_file] --baseline=[json_file] \
+            --tolerance=[fraction]"
+
+    opts, args = getopt.getopt(argv[1:], "h", ["help", "bench=", "datasets=", "k=", "repeat=", "trees=", "jobs=",
+                                               "recipes=", "classifiers=", "scales=", "epochs=", "max-rows=", "seed=",
+                                               "data-dir=", "output=", "baseline=", "tolerance="])
+    bench = "knn_index"
+    names = None
+    k = 1
+    repeat = 20
+    num_trees = 50
+    jobs = -1
+    recipe_file = "command_line.txt"
+    class_names = wrapper.CLASSIFIERS
+    scales = [1, 10, 100]
+    epochs = 50
+    max_rows = 50000
+    seed = 0
+    data_dir = ".bench_data"
+    output = "bench_results.json"
+    baseline = None
+    tolerance = .25
+
+    for key, val in opts:
+        if key in ("-h", "--help"):
+            print(usage)
+            sys.exit()
+        elif key == "--bench":
+            bench = val
+        elif key == "--datasets":
+            names = val.split(",")
+        elif key == "--k":
+            k = int(val)
+        elif key == "--repeat":
+            repeat = int(val)
+        elif key == "--trees":
+            num_trees = int(val)
+        elif key == "--jobs":
+            jobs = int(val)
+        elif key == "--recipes":
+            recipe_file = val
+        elif key == "--classifiers":
+            class_names = val.split(",")
+        elif key == "--scales":
+            scales = [int(scale) for scale in val.split(",")]
+        elif key == "--epochs":
+            epochs = int(val)
+        elif key == "--max-rows":
+            max_rows = int(val)
+        elif key == "--seed":
+            seed = int(val)
+        elif key == "--data-dir":
+            data_dir = val
+        elif key == "--output":
+            output = val
+        elif key == "--baseline":
+            baseline = val
+        elif key == "--tolerance":
+            tolerance = float(val)
+        else:
+            assert False, "unhandled option"
+
+    if bench == "knn_index":
+        bench_knn_index(names or ["iris", "breast_cancer", "chess"], k)
+    elif bench == "id3_predict":
+        bench_id3_predict(names or ["car", "chess", "credit"], repeat)
+    elif bench == "forest":
+        bench_forest(names or ["car", "chess", "credit"], num_trees, jobs)
+    elif bench == "perceptron_alloc":
+        if not bench_perceptron_alloc(names or ["diabetes"], [1, 16], [1, 10]):
+            sys.exit(1)
+    elif bench == "suite":
+        if not bench_suite(recipe_file, names, class_names, scales, epochs, max_rows, seed, data_dir, output, baseline,
+                           tolerance):
+            sys.exit(1)
+    else:
+        print("Unrecognized benchmark")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
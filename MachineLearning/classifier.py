@@ -1,8 +1,52 @@
 import sys
 import numpy as np
-import copy
-import random
 import math
+import multiprocessing
+import profiler
+
+
+########################################################################################
+# Parallel prediction
+# Splits the test rows into shards and predicts them across a pool of processes. The
+# trained model is handed to each worker once when the pool starts, and the shards
+# come back in their original order.
+########################################################################################
+worker_model = None
+
+
+def init_predict_worker(model):
+    global worker_model
+    worker_model = model
+
+
+def predict_shard(shard):
+    return worker_model.predict_serial(shard)
+
+
+def parallel_predict(model, attributes, n_jobs):
+    """
+    Predicts attributes with model.predict_serial spread across n_jobs processes. An n_jobs of -1
+    uses every core.
+    :param model:
+    :param attributes:
+    :param n_jobs:
+    :return:
+    """
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(attributes))
+    if n_jobs <= 1:
+        return model.predict_serial(attributes)
+
+    # use a few shards per worker so a slow shard doesn't hold up the whole pool
+    shards = np.array_split(np.asarray(attributes), n_jobs * 4)
+    with multiprocessing.Pool(n_jobs, initializer=init_predict_worker, initargs=(model,)) as pool:
+        results = pool.map(predict_shard, shards)
+
+    predictions = []
+    for result in results:
+        predictions.extend(result)
+    return predictions
 
 
 ########################################################################################
@@ -17,7 +61,7 @@ class HardCoded:
 
         predicts = []
 
-        for row in attributes[0]:
+        for row in attributes:
             predicts.append(0)
 
         return predicts
@@ -26,11 +70,24 @@ class HardCoded:
 ########################################################################################
 # KNearestNeighbor
 # Uses the k nearest neighbors algorithm to predict a class. The parameter k is the
-# number of neighbors used for classification.
+# number of neighbors used for classification. Setting index to 'kdtree' builds a
+# KDTree when training so queries don't have to scan the whole training set, and
+# 'lsh' builds an approximate LSHIndex with lsh_tables hash tables. weighted makes
+# closer neighbors count for more in the vote.
 ########################################################################################
 class KNearestNeighbor:
-    def __init__(self, k=1):
+    def __init__(self, k=1, chunk_size=256, index=None, leaf_size=256, weighted=False, n_jobs=1,
+                 lsh_tables=8, lsh_hashes=4, seed=None):
         self.k = k
+        self.weighted = weighted
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size    # number of test rows compared against the training set at once
+        self.index = index
+        self.leaf_size = leaf_size
+        self.lsh_tables = lsh_tables
+        self.lsh_hashes = lsh_hashes
+        self.seed = seed
+        self.searcher = None
         self.attributes = []
         self.targets = []
         self.mapped = []
@@ -40,183 +97,716 @@ class KNearestNeighbor:
         self.targets = targets
         self.mapped = mapped
 
+        with profiler.timer("knn.build_index"):
+            if self.index == "kdtree":
+                self.searcher = KDTree(attributes, mapped, self.leaf_size)
+            elif self.index == "lsh":
+                self.searcher = LSHIndex(attributes, mapped, self.lsh_tables, self.lsh_hashes, seed=self.seed)
+            elif self.index is not None:
+                raise ValueError("Unrecognized index: " + str(self.index))
+
     def predict(self, test_attributes):
+        if self.n_jobs != 1:
+            return parallel_predict(self, test_attributes, self.n_jobs)
+        return self.predict_serial(test_attributes)
+
+    def predict_serial(self, test_attributes):
         # initialize data
         predictions = [-1] * len(test_attributes)
 
-        for i, test_val in enumerate(test_attributes):
-            distances = [float('inf')] * len(self.attributes)
-            for j, train_val in enumerate(self.attributes):
-                distances[j] = self.get_distance(test_val, train_val)
-            k_nearest = self.get_k_nearest(distances)
-            predictions[i] = self.get_avg_target(k_nearest)
+        with profiler.timer("knn.kneighbors"):
+            k_nearest, k_distances = self.kneighbors(test_attributes)
+        with profiler.timer("knn.vote"):
+            for i in range(len(k_nearest)):
+                predictions[i] = self.get_avg_target(k_nearest[i], k_distances[i])
+        profiler.count("knn.rows_predicted", len(predictions))
 
         return predictions
 
-    # gets euclidean distance between vector 1 and vector 2
-    def get_distance(self, v1, v2):
-        dist = 0.0
-        for idx, val in enumerate(v1):
-            # if it's not a mapped column find the distance in the standard way
-            if not self.mapped[idx]:
-                dist += (v1[idx] - v2[idx]) * (v1[idx] - v2[idx])
-            # otherwise distance is 1 unless the values are the same
-            else:
-                dist += 0 if v1[idx] == v2[idx] else .5
-        return dist
+    def predict_each_k(self, test_attributes, ks):
+        """
+        Returns the predictions for several values of k, finding the neighbors only once for the
+        largest k. The nearest neighbors for a smaller k are the first ones of the larger search.
+        :param test_attributes:
+        :param ks:
+        :return: map of each k to its list of predictions
+        """
+        k = self.k
+        self.k = max(ks)
+        try:
+            k_nearest, k_distances = self.kneighbors(test_attributes)
+        finally:
+            self.k = k
+        return {k: [self.get_avg_target(k_nearest[i, :k], k_distances[i, :k]) for i in range(len(k_nearest))]
+                for k in ks}
+
+    def kneighbors(self, test_attributes):
+        """
+        Returns the indices of the k nearest training rows for every test row along with their
+        distances, both sorted from nearest to farthest
+        :param test_attributes:
+        :return:
+        """
+        test_attributes = np.asarray(test_attributes, dtype=float)
+        k = min(self.k, len(self.attributes))
+        k_nearest = np.zeros((len(test_attributes), k), dtype=int)
+        k_distances = np.zeros((len(test_attributes), k))
+
+        if isinstance(self.searcher, KDTree):
+            return self.searcher.query_batch(test_attributes, k, self.chunk_size)
+        if self.searcher is not None:
+            for i, test_val in enumerate(test_attributes):
+                k_nearest[i], k_distances[i] = self.searcher.query(test_val, k)
+            return k_nearest, k_distances
+
+        # compare the test rows against the training set one chunk at a time so the
+        # distance matrix never grows past chunk_size x len(self.attributes)
+        for start in range(0, len(test_attributes), self.chunk_size):
+            distances = pairwise_distances(test_attributes[start:start + self.chunk_size], self.attributes,
+                                           self.mapped)
+            for i, row in enumerate(distances):
+                k_nearest[start + i] = self.get_k_nearest(row)
+                k_distances[start + i] = row[k_nearest[start + i]]
+
+        return k_nearest, k_distances
 
-    # get the best prediction based of k nearest points
     def get_k_nearest(self, distances):
-        k_nearest = [-1] * self.k
-        k_distances = [sys.float_info.max] * self.k
-
-        for idx, d in enumerate(distances):
-            i = 0
-            while i < self.k:
-                if d < k_distances[i]:
-                    j = self.k - 1
-                    while j >= i:
-                        k_distances[j] = k_distances[j - 1]
-                        k_nearest[j] = k_nearest[j - 1]
-                        j -= 1
-                    k_distances[i] = d
-                    k_nearest[i] = idx
-                    i = self.k
-                i += 1
-
-        return k_nearest
-
-    # predict a target based on k_nearest neighbors
-    def get_avg_target(self, k_nearest):
-        # all of our target values for k_nearest points
-        targets = []
-        for idx in k_nearest:
-            targets.append(self.targets[idx])
-        # sort the target values to easily find the mode
-        targets = sorted(targets)
-
-        longest_t = targets[0]    # currently longest t
-        current_count = 0         # current count of t
-        longest_count = 0         # longest count of t
-        i = 1
-        while i < len(k_nearest):
-            t = targets[i]
-            if t == targets[i - 1]:
-                current_count += 1
+        """
+        Returns the indices of the k smallest distances sorted from nearest to farthest. Only the
+        rows at or below the k-th smallest distance are sorted, and ties go to the lower index.
+        :param distances:
+        :return:
+        """
+        distances = np.asarray(distances)
+        k = min(self.k, len(distances))
+        if k < len(distances):
+            kth = np.partition(distances, k - 1)[k - 1]
+            candidates = np.flatnonzero(distances <= kth)
+        else:
+            candidates = np.arange(len(distances))
+
+        order = np.argsort(distances[candidates], kind="stable")[:k]
+        return candidates[order]
+
+    def get_avg_target(self, k_nearest, distances=None):
+        """
+        Predicts a target by majority vote of the k nearest neighbors. When weighted is set each
+        vote counts 1 / distance. Ties go to the smallest target value.
+        :param k_nearest:
+        :param distances:
+        :return:
+        """
+        targets = np.asarray(self.targets)[np.asarray(k_nearest, dtype=int), 0]
+        values, counts_index = np.unique(targets, return_inverse=True)
+
+        weights = None
+        if self.weighted and distances is not None:
+            weights = 1.0 / (np.asarray(distances, dtype=float) + sys.float_info.epsilon)
+
+        votes = np.bincount(counts_index, weights=weights, minlength=len(values))
+        return values[np.argmax(votes)]
+
+
+########################################################################################
+# KDTree
+# A spatial index over the training attributes using the same metric as
+# pairwise_distances. Numeric columns are split at their median and
+# mapped columns are split into the rows equal to one value and the rest, so a
+# branch can be skipped whenever the smallest distance it could contain is already
+# larger than the k-th best distance found.
+#
+# Queries are answered in batches: the points are sorted by the leaf they fall in and
+# walk the tree together, and each leaf is scanned for all the points reaching it with
+# one distance matrix. Leaves are large (leaf_size rows) since a vectorized scan of a
+# few hundred rows costs about the same as visiting one more node.
+########################################################################################
+class KDTree:
+    def __init__(self, attributes, mapped, leaf_size=256):
+        self.data = np.asarray(attributes, dtype=float)
+        self.mapped = [bool(mapped[idx]) for idx in range(self.data.shape[1])]
+        self.leaf_size = max(1, leaf_size)
+
+        # the tree is stored as parallel lists. Leaves point at a range of self.order,
+        # inner nodes at the index of their two children.
+        self.split_col = []
+        self.split_val = []
+        self.children = []
+        self.start = []
+        self.end = []
+
+        self.order = np.arange(len(self.data))
+        if len(self.data) > 0:
+            self.build(0, len(self.data))
+
+    def build(self, start, end):
+        """
+        Recursively builds the node covering self.order[start:end] and returns its index
+        :param start:
+        :param end:
+        :return:
+        """
+        node = len(self.split_col)
+        self.split_col.append(-1)
+        self.split_val.append(0.0)
+        self.children.append(None)
+        self.start.append(start)
+        self.end.append(end)
+
+        if end - start <= self.leaf_size:
+            return node
+
+        rows = self.order[start:end]
+        points = self.data[rows]
+
+        # split on the column which contributes the most to the expected distance between
+        # two random points in this node
+        best_col = -1
+        best_spread = 0.0
+        for col in range(points.shape[1]):
+            values = points[:, col]
+            if self.mapped[col]:
+                counts = np.unique(values, return_counts=True)[1] / len(values)
+                spread = .5 * (1 - np.sum(counts * counts))
             else:
-                if current_count > longest_count:
-                    longest_count = current_count
-                    longest_t = targets[i - 1]
-                    current_count = 0
-            i += 1
+                spread = 2 * values.var()
+            if spread > best_spread:
+                best_spread = spread
+                best_col = col
+
+        if best_col < 0:
+            return node
+
+        values = points[:, best_col]
+        if self.mapped[best_col]:
+            uniques, counts = np.unique(values, return_counts=True)
+            split = uniques[np.argmax(counts)]
+            left = values == split
+        else:
+            split = np.median(values)
+            left = values < split
+            if left.all() or not left.any():
+                left = values <= split
 
-        if current_count > longest_count:
-            longest_t = targets[i - 1]
+        if left.all() or not left.any():
+            return node
 
-        return longest_t
+        # stable partition so rows inside each leaf stay in training order
+        self.order[start:end] = np.concatenate((rows[left], rows[~left]))
+        middle = start + int(np.count_nonzero(left))
+
+        self.split_col[node] = best_col
+        self.split_val[node] = split
+        self.children[node] = (self.build(start, middle), self.build(middle, end))
+        return node
+
+    def query(self, point, k):
+        """
+        Returns the indices of the k nearest training rows and their distances, sorted by
+        distance. Ties are broken by the lower training index, which matches
+        KNearestNeighbor.get_k_nearest.
+        :param point:
+        :param k:
+        :return:
+        """
+        k_nearest, k_distances = self.query_batch(np.asarray(point, dtype=float).reshape(1, -1), k)
+        return k_nearest[0].tolist(), k_distances[0].tolist()
+
+    def query_batch(self, points, k, chunk_size=256):
+        """
+        Returns the indices of the k nearest training rows for every row of points and their
+        distances, as two arrays with one row per point sorted like query. The points walk the
+        tree chunk_size at a time, so each node visited costs one set of array operations for
+        all the points of the chunk which reach it instead of one call per point. The points are
+        first sorted by the leaf they fall in, so the points of a chunk are near each other and
+        share most of the nodes they visit.
+        :param points:
+        :param k:
+        :param chunk_size:
+        :return:
+        """
+        points = np.asarray(points, dtype=float)
+        # best k so far for every point. Unfilled slots hold an infinite distance and an index
+        # past the end, so they sort last and never prune anything.
+        best_distances = np.full((len(points), k), np.inf)
+        best_rows = np.full((len(points), k), len(self.data), dtype=np.intp)
+        if len(self.data) == 0 or len(points) == 0:
+            return best_rows, best_distances
+
+        order = np.argsort(self.find_leaves(points), kind="stable")
+        for start in range(0, len(order), chunk_size):
+            queries = order[start:start + chunk_size]
+            self.search(0, points, queries, np.zeros(len(queries)), np.zeros((len(queries), points.shape[1])),
+                        best_distances, best_rows)
+        return best_rows, best_distances
+
+    def find_leaves(self, points):
+        """
+        Returns the leaf each of points falls in, walking the tree for all of them at once
+        :param points:
+        :return:
+        """
+        split_col = np.array(self.split_col)
+        split_val = np.array(self.split_val)
+        children = np.array([(-1, -1) if pair is None else pair for pair in self.children])
+        mapped = np.array(self.mapped + [False])
+
+        nodes = np.zeros(len(points), dtype=np.intp)
+        active = np.flatnonzero(split_col[nodes] >= 0)
+        while len(active):
+            cols = split_col[nodes[active]]
+            vals = points[active, cols]
+            splits = split_val[nodes[active]]
+            go_left = np.where(mapped[cols], vals == splits, vals < splits)
+            nodes[active] = children[nodes[active], np.where(go_left, 0, 1)]
+            active = active[split_col[nodes[active]] >= 0]
+        return nodes
+
+    def search(self, node, points, queries, bounds, offsets, best_distances, best_rows):
+        """
+        Searches node for the points with the given indices. bounds holds the smallest distance
+        each of them could have to a row in node, built up from offsets, the squared distance to
+        the node's region along each column.
+        :return:
+        """
+        col = self.split_col[node]
+        if col < 0:
+            self.scan_leaf(node, points[queries], queries, best_distances, best_rows)
+            return
+
+        split = self.split_val[node]
+        vals = points[queries, col]
+        left, right = self.children[node]
+        if self.mapped[col]:
+            # the left child holds the rows equal to split, the right one everything else
+            left_near = vals == split
+            far_offsets = np.full(len(queries), .5)
+        else:
+            left_near = vals < split
+            far_offsets = (vals - split) * (vals - split)
+
+        # visit the near child first for every point, so the far child is only entered with
+        # the k-th distance found on the near side. Points nearer the left child go left, then
+        # the right child takes both the points nearer it and the points coming from the left.
+        near_left = np.flatnonzero(left_near)
+        near_right = np.flatnonzero(~left_near)
+        if len(near_left):
+            self.search(left, points, queries[near_left], bounds[near_left], offsets[near_left],
+                        best_distances, best_rows)
+
+        far = self.far_side(col, near_left, queries, bounds, offsets, far_offsets, best_distances)
+        right_queries = np.concatenate((queries[near_right], queries[near_left][far[0]]))
+        if len(right_queries):
+            self.search(right, points, right_queries, np.concatenate((bounds[near_right], far[1])),
+                        np.concatenate((offsets[near_right], far[2])), best_distances, best_rows)
+
+        far = self.far_side(col, near_right, queries, bounds, offsets, far_offsets, best_distances)
+        if len(far[0]):
+            self.search(left, points, queries[near_right][far[0]], far[1], far[2], best_distances, best_rows)
+
+    def far_side(self, col, members, queries, bounds, offsets, far_offsets, best_distances):
+        """
+        Finds which of the given points still need to search the far child, since the far side
+        can't be closer than the distance to the splitting plane
+        :return: positions in members of the points which do, and their new bounds and offsets
+        """
+        old_offsets = offsets[members, col]
+        new_offsets = np.maximum(old_offsets, far_offsets[members])
+        far_bounds = bounds[members] - old_offsets + new_offsets
+        keep = np.flatnonzero(far_bounds <= best_distances[queries[members], -1] * (1 + 1e-9))
+        far_offset_rows = offsets[members[keep]]
+        far_offset_rows[:, col] = new_offsets[keep]
+        return keep, far_bounds[keep], far_offset_rows
+
+    def scan_leaf(self, node, points, queries, best_distances, best_rows):
+        """
+        Computes the distances from the points to every row of the leaf and merges them into the
+        best k of each point
+        :return:
+        """
+        rows = self.order[self.start[node]:self.end[node]]
+        distances = pairwise_distances(points, self.data[rows], self.mapped)
+
+        # keep the k smallest of the old best and the leaf rows, by distance and then index
+        k = best_distances.shape[1]
+        candidate_distances = np.hstack((best_distances[queries], distances))
+        candidate_rows = np.hstack((best_rows[queries], np.broadcast_to(rows, distances.shape)))
+        order = np.lexsort((candidate_rows, candidate_distances))[:, :k]
+        best_distances[queries] = np.take_along_axis(candidate_distances, order, axis=1)
+        best_rows[queries] = np.take_along_axis(candidate_rows, order, axis=1)
 
 
 ########################################################################################
-# KNearestNeighbor
-# Uses the k nearest neighbors algorithm to predict a class. The parameter k is the
-# number of neighbors used for classification.
+# LSHIndex
+# An approximate index using locality sensitive hashing. Every table hashes a row by
+# a handful of functions, each one either a random projection of the numeric columns
+# cut into buckets of bucket_width, or the value of a randomly chosen mapped column.
+# A query only computes exact distances to the training rows sharing a bucket with
+# it in at least one table. More tables find more of the true neighbors (higher
+# recall) at the cost of more candidates per query; more hashes per table make the
+# buckets smaller and queries faster but lower the recall.
+########################################################################################
+class LSHIndex:
+    def __init__(self, attributes, mapped, num_tables=8, num_hashes=4, bucket_width=None, seed=None):
+        self.data = np.asarray(attributes, dtype=float)
+        self.mapped = [bool(mapped[idx]) for idx in range(self.data.shape[1])]
+        self.num_tables = num_tables
+        self.num_hashes = num_hashes
+        rng = np.random.RandomState(seed)
+
+        numeric = [idx for idx, m in enumerate(self.mapped) if not m]
+        categorical = [idx for idx, m in enumerate(self.mapped) if m]
+        self.numeric = numeric
+
+        # by default make the buckets about as wide as the spread of the numeric columns
+        if bucket_width is None:
+            spread = np.sqrt(self.data[:, numeric].var(axis=0).sum()) if numeric else 0.0
+            bucket_width = spread if spread > 0 else 1.0
+        self.bucket_width = bucket_width
+
+        # each hash function is either a projection (column -1) or a mapped column
+        self.columns = np.zeros((num_tables, num_hashes), dtype=int)
+        self.projections = rng.normal(size=(num_tables, num_hashes, len(numeric)))
+        self.offsets = rng.uniform(0, bucket_width, size=(num_tables, num_hashes))
+        for t in range(num_tables):
+            for h in range(num_hashes):
+                col = rng.randint(len(self.mapped))
+                self.columns[t, h] = col if self.mapped[col] else -1
+                if not numeric and categorical:
+                    self.columns[t, h] = categorical[rng.randint(len(categorical))]
+
+        # for every table group the rows by their key. Rows of a bucket are kept as a range
+        # of self.order[t] and self.buckets[t] maps the key to that range.
+        self.order = []
+        self.buckets = []
+        for t in range(num_tables):
+            keys = self.hash(self.data, t)
+            uniques, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.searchsorted(inverse[order], np.arange(len(uniques) + 1))
+            self.order.append(order)
+            self.buckets.append({uniques[b].tobytes(): (bounds[b], bounds[b + 1])
+                                 for b in range(len(uniques))})
+
+    def hash(self, points, table):
+        """
+        Returns the bucket key of every row in points for the given table
+        :param points:
+        :param table:
+        :return:
+        """
+        projected = points[:, self.numeric].dot(self.projections[table].T) + self.offsets[table]
+        keys = np.floor(projected / self.bucket_width).astype(np.int64)
+        for h, col in enumerate(self.columns[table]):
+            if col >= 0:
+                keys[:, h] = points[:, col].astype(np.int64)
+        return keys
+
+    def candidates(self, point):
+        """
+        Returns the sorted indices of every training row sharing a bucket with point
+        :param point:
+        :return:
+        """
+        point = np.asarray(point, dtype=float).reshape(1, -1)
+        found = []
+        for t in range(self.num_tables):
+            bucket = self.buckets[t].get(self.hash(point, t)[0].tobytes())
+            if bucket is not None:
+                found.append(self.order[t][bucket[0]:bucket[1]])
+        if not found:
+            return np.zeros(0, dtype=int)
+        return np.unique(np.concatenate(found))
+
+    def query(self, point, k):
+        """
+        Returns the indices and distances of the k nearest rows among the candidates, sorted by
+        distance with ties going to the lower index. When the buckets hold fewer than k rows the
+        whole training set is searched.
+        :param point:
+        :param k:
+        :return:
+        """
+        rows = self.candidates(point)
+        if len(rows) < k:
+            rows = np.arange(len(self.data))
+
+        distances = pairwise_distances(point[np.newaxis], self.data[rows], self.mapped)[0]
+        if k < len(rows):
+            kth = np.partition(distances, k - 1)[k - 1]
+            keep = np.flatnonzero(distances <= kth)
+        else:
+            keep = np.arange(len(rows))
+        keep = keep[np.argsort(distances[keep], kind="stable")[:k]]
+        return rows[keep].tolist(), distances[keep].tolist()
+
+
+def pairwise_distances(points, rows, mapped):
+    """
+    Returns a matrix of squared euclidean distances between every row of points and every row of
+    rows. Mapped columns add .5 when the values differ instead of their squared difference. This is
+    the metric used by KNearestNeighbor, KDTree and LSHIndex.
+    :param points:
+    :param rows:
+    :param mapped: list of whether each column is mapped
+    :return:
+    """
+    rows = np.asarray(rows, dtype=float)
+    dist = np.zeros((len(points), len(rows)))
+    profiler.count("knn.distances", dist.size)
+    for idx in range(points.shape[1]):
+        diff = points[:, idx:idx + 1] - rows[:, idx]
+        # if it's not a mapped column find the distance in the standard way
+        if not mapped[idx]:
+            dist += diff * diff
+        # otherwise distance is .5 unless the values are the same
+        else:
+            dist += np.where(diff == 0, 0.0, .5)
+    return dist
+
+
+########################################################################################
+# ID3
+# Builds a decision tree by splitting on the feature with the lowest resulting
+# entropy. After training the tree is compiled into flat arrays which predict walks
+# for all rows at once. Set keep_nodes to False to drop the ID3Node objects once
+# the tree is compiled. When max_features is set each node only considers that many
+# randomly chosen features, which RandomForest uses to decorrelate its trees.
 ########################################################################################
 class ID3:
-    def __init__(self):
+    def __init__(self, n_jobs=1, keep_nodes=True, max_features=None, seed=None):
+        self.n_jobs = n_jobs
+        self.keep_nodes = keep_nodes
+        self.max_features = max_features
+        self.rng = np.random.RandomState(seed)
         self.attributes = []
         self.targets = []
         self.target_possible_values = []
         self.root = None
 
+        # the compiled tree. Node 0 is the root. Leaves have a feature of -1 and their
+        # prediction in node_value, other nodes hold their default value there. The child
+        # for code c of a node's feature is branches[branch_start[node] + c], or -1 if the
+        # value wasn't seen in training.
+        self.node_feature = None
+        self.node_value = None
+        self.branch_start = None
+        self.branches = None
+
     def train(self, attributes, targets):
         self.attributes = attributes
         self.targets = targets
-
-        # get the possible values of the target
-        for row in self.targets:
-            val = row[0]
-            if val not in self.target_possible_values:
-                self.target_possible_values.append(val)
+        attributes = np.asarray(attributes)
+        targets = np.asarray(targets)
+
+        with profiler.timer("id3.encode"):
+            # get the possible values of the target
+            self.target_possible_values, target_codes = np.unique(targets[:, 0], return_inverse=True)
+
+            # replace every attribute value with its index in the sorted unique values of its
+            # column so the splits can be counted with bincount. The codes are stored column major
+            # in the smallest integer type that fits, since nodes read them a column at a time.
+            self.feature_values = [np.unique(attributes[:, col]) for col in range(attributes.shape[1])]
+            largest = max([len(values) for values in self.feature_values] + [1])
+            codes = np.zeros(attributes.shape, dtype=np.min_scalar_type(largest), order="F")
+            for col, values in enumerate(self.feature_values):
+                codes[:, col] = np.searchsorted(values, attributes[:, col])
+            target_codes = target_codes.astype(np.min_scalar_type(len(self.target_possible_values)))
+
+            # the first row of the count table belonging to each feature
+            self.feature_offsets = np.cumsum([0] + [len(values) for values in self.feature_values])
+            self.feature_of_row = np.repeat(np.arange(len(self.feature_values)), np.diff(self.feature_offsets))
 
         # create array of feature values
-        features = [0] * len(attributes[0])
-        for idx, val in enumerate(features):
-            features[idx] = idx
+        features = list(range(attributes.shape[1]))
 
-        self.root = self.build_tree(attributes, targets, features)
+        with profiler.timer("id3.build"):
+            self.root = self.build_tree(codes, target_codes, features)
+        with profiler.timer("id3.compile"):
+            self.compile_tree()
+        if not self.keep_nodes:
+            self.root = None
 
-    def build_tree(self, attributes, targets, features):
+    def build_tree(self, codes, target_codes, features):
         """
-        Recursive function to build a tree. Returns a leaf value containing the predicted target value, or
-        a new ID3_Node
-        :param attributes:
-        :param targets:
+        Builds the tree and returns its root, which is either a leaf value containing the predicted
+        target value or an ID3Node. Every node owns a range of one shared array of row indices and
+        partitions that range in place for its children, so rows are never copied. Nodes waiting
+        to be built are kept on an explicit stack instead of recursing.
+        :param codes:
+        :param target_codes:
         :param features:
         :return:
         """
-        # get the number of various target values
-        targets_map = {}
-        for array_val in targets:
-            val = array_val[0]
-            if val in targets_map:
-                targets_map[val] += 1
-            else:
-                targets_map[val] = 1
+        rows = np.arange(len(target_codes))
+        root = {}
+        # each entry is (branches to add the result to, key, start, end, features)
+        stack = [(root, None, 0, len(rows), features)]
+        while stack:
+            branches, key, start, end, features = stack.pop()
+            branches[key] = self.build_node(codes, target_codes, rows, start, end, features, stack)
 
-        largest_num = 0
-        largest_target = -1
-        for target, num in targets_map.items():
-            if num > largest_num:
-                largest_target = target
+        return root[None]
+
+    def build_node(self, codes, target_codes, rows, start, end, features, stack):
+        """
+        Returns a leaf value or a new ID3Node for the rows in rows[start:end]. Children which need to
+        be split further are pushed onto stack.
+        :param codes:
+        :param target_codes:
+        :param rows:
+        :param start:
+        :param end:
+        :param features:
+        :param stack:
+        :return:
+        """
+        profiler.count("id3.nodes")
+        node_rows = rows[start:end]
+        node_targets = target_codes[node_rows]
+
+        # get the number of various target values
+        target_counts = np.bincount(node_targets, minlength=len(self.target_possible_values))
+        largest_target = self.target_possible_values[np.argmax(target_counts)]
 
         # if all remaining share the same target value, then return it as a leaf
-        if len(targets_map) <= 1:
-            return targets[0][0]
+        if np.count_nonzero(target_counts) <= 1:
+            return self.target_possible_values[node_targets[0]]
         # if there are no more features remaining, return target value with most
         elif len(features) <= 0:
             return largest_target
-        else:
-            node = ID3Node()
-            # assign the default value as the target with the most records
-            node.default_value = largest_target
-
-            # get the next feature to split on
-            current_min = sys.float_info.max
-            lowest_feature = -1
-            for feature in features:
-                feature_val = self.calc_info_gain(attributes, targets, feature)
-                if feature_val < current_min:
-                    current_min = feature_val
-                    lowest_feature = feature
-
-            # now separate targets and attributes
-            node.attr_index = lowest_feature
-            new_attributes = {}
-            new_targets = {}
-            for idx, attr_row in enumerate(attributes):
-                val = attr_row[lowest_feature]
-                if val not in new_attributes:
-                    new_attributes[val] = []
-                    new_targets[val] = []
-                new_attributes[val].append(attributes[idx])
-                new_targets[val].append(targets[idx])
-
-            new_features = copy.deepcopy(features)
-            new_features.remove(lowest_feature)
-
-            # build the subtrees
-            for key in new_attributes.keys():
-                node.branches[key] = self.build_tree(new_attributes[key], new_targets[key], new_features)
 
-            return node
+        node = ID3Node()
+        # assign the default value as the target with the most records
+        node.default_value = largest_target
+
+        # get the next feature to split on. Entropies within rounding error of each other are
+        # treated as equal so the first of the tied features is used.
+        candidates = features
+        if self.max_features is not None and self.max_features < len(features):
+            candidates = sorted(self.rng.choice(features, self.max_features, replace=False).tolist())
+        profiler.count("id3.info_gains", len(candidates))
+        table = self.count_targets(codes, node_targets, candidates, node_rows)
+        entropies = self.calc_split_entropies(table, len(node_rows))[candidates]
+        lowest_feature = candidates[int(np.argmax(entropies <= entropies.min() + 1e-12))]
+        node.attr_index = lowest_feature
+
+        # now separate the rows by their value, keeping their relative order
+        column = codes[node_rows, lowest_feature]
+        values, first_seen = np.unique(column, return_index=True)
+        rows[start:end] = node_rows[np.argsort(column, kind="stable")]
+        branch_counts = table[self.feature_offsets[lowest_feature]:self.feature_offsets[lowest_feature + 1]]
+        branch_ends = start + np.cumsum(branch_counts.sum(axis=1))
+
+        new_features = list(features)
+        new_features.remove(lowest_feature)
+
+        # add the branches in the order the values first appear. The count table already tells us
+        # which branches hold a single target value, so those become leaves right away.
+        pure = (np.count_nonzero(branch_counts, axis=1) == 1).tolist()
+        majority = self.target_possible_values[np.argmax(branch_counts, axis=1)].tolist()
+        keys = self.feature_values[lowest_feature].tolist()
+        branch_ends = branch_ends.tolist()
+        children = []
+        for code in values[np.argsort(first_seen)].tolist():
+            key = keys[code]
+            if pure[code]:
+                node.branches[key] = majority[code]
+            else:
+                node.branches[key] = None
+                branch_start = branch_ends[code - 1] if code > 0 else start
+                children.append((node.branches, key, branch_start, branch_ends[code], new_features))
 
-    def predict(self, attributes):
-        predicts = [None] * len(attributes)
+        # push in reverse so the branches are built in the same order as they were added
+        stack.extend(reversed(children))
 
-        for idx, attribute in enumerate(attributes):
-            predicts[idx] = self.traverse_tree(attribute, self.root)
+        return node
 
-        return predicts
+    def predict(self, attributes):
+        if self.n_jobs != 1:
+            return parallel_predict(self, attributes, self.n_jobs)
+        return self.predict_serial(attributes)
+
+    def predict_serial(self, attributes):
+        profiler.count("id3.rows_predicted", len(attributes))
+        attributes = np.asarray(attributes, dtype=float)
+        codes = self.encode(attributes)
+        predicts = np.zeros(len(attributes))
+
+        # move every row down one level of the tree per pass until it reaches a leaf or a
+        # value with no branch
+        active = np.arange(len(attributes))
+        node = np.zeros(len(attributes), dtype=self.branches.dtype)
+        while len(active) > 0:
+            feature = self.node_feature[node]
+            leaf = feature < 0
+            predicts[active[leaf]] = self.node_value[node[leaf]]
+            active, node, feature = active[~leaf], node[~leaf], feature[~leaf]
+
+            code = codes[active, feature]
+            child = np.where(code < 0, -1, self.branches[self.branch_start[node] + np.maximum(code, 0)])
+            missing = child < 0
+            predicts[active[missing]] = self.node_value[node[missing]]
+            active, node = active[~missing], child[~missing]
+
+        return predicts.tolist()
+
+    def encode(self, attributes):
+        """
+        Replaces every attribute value with its code from training, or -1 if the value wasn't seen.
+        Only the columns the tree splits on are encoded.
+        :param attributes:
+        :return:
+        """
+        codes = np.full(attributes.shape, -1, dtype=np.intp)
+        for col in np.unique(self.node_feature[self.node_feature >= 0]).tolist():
+            values = self.feature_values[col]
+            pos = np.minimum(np.searchsorted(values, attributes[:, col]), len(values) - 1)
+            codes[:, col] = np.where(values[pos] == attributes[:, col], pos, -1)
+        return codes
+
+    def compile_tree(self):
+        """
+        Flattens the tree of ID3Nodes into the node_feature, node_value, branch_start and branches
+        arrays. Leaves with the same value share a single node.
+        :return:
+        """
+        node_feature = []
+        node_value = []
+        branch_start = []
+        branches = []
+        leaves = {}
+
+        def add_node(item):
+            if isinstance(item, ID3Node):
+                node_feature.append(item.attr_index)
+                node_value.append(item.default_value)
+                branch_start.append(0)
+                queue.append((len(node_feature) - 1, item))
+                return len(node_feature) - 1
+            if item not in leaves:
+                leaves[item] = len(node_feature)
+                node_feature.append(-1)
+                node_value.append(item)
+                branch_start.append(0)
+            return leaves[item]
+
+        queue = []
+        add_node(self.root)
+        while queue:
+            idx, node = queue.pop()
+            keys = self.feature_values[node.attr_index]
+            branch_start[idx] = len(branches)
+            table = [-1] * len(keys)
+            for key, branch in node.branches.items():
+                table[int(np.searchsorted(keys, key))] = add_node(branch)
+            branches.extend(table)
+
+        index_type = np.min_scalar_type(-max(len(node_feature), len(branches), 1))
+        self.node_feature = np.array(node_feature, dtype=np.min_scalar_type(-max(len(self.feature_values), 1)))
+        self.node_value = np.array(node_value, dtype=float)
+        self.branch_start = np.array(branch_start, dtype=index_type)
+        self.branches = np.array(branches, dtype=index_type)
 
     def traverse_tree(self, attr, node):
         # check and see if the branch exists
@@ -248,63 +838,52 @@ class ID3:
         else:
             print(tabs, node)
 
-    def calc_info_gain(self, attributes, targets, feature):
+    def count_targets(self, codes, target_codes, features, rows):
         """
-        Calculates the total entropy value of the resulting set created by splitting the initial set
-        by the given feature
-        :param attributes:
-        :param targets:
-        :param feature:
+        Builds a contingency table with one row per (feature, attribute value) pair and one column per
+        target value, counting the given rows of codes. Rows of features which weren't given are left
+        at 0.
+        :param codes:
+        :param target_codes:
+        :param features:
+        :param rows:
         :return:
         """
-        # get the count of each attribute val
-        attribute_map = {}  # a map of the attribute value to a map of target values to a count of each
-        attribute_totals = {} # a map of the attribute values of a total number of target values
-        for att_index, attr in enumerate(attributes):
-            val = attr[feature]
-            if val not in attribute_map:
-                attribute_map[val] = self.get_target_map()
-                attribute_totals[val] = 0
-
-            attribute_map[val][targets[att_index][0]] += 1
-            attribute_totals[val] += 1
-
-        # finally calculate the information gain
-        gain = 0.0
-        num_attributes = len(attributes)
-        for attr, attr_num in attribute_totals.items():
-            num_targets = attribute_totals[attr]
-            entropy = 0.0
-            for target_val, target_num in attribute_map[attr].items():
-                entropy += self.calc_entropy(target_num / num_targets)
-            # scale the value by the number of occurances of the attribute
-            entropy *= attr_num / num_attributes
-
-            gain += entropy
-
-        return gain
-
-    def calc_entropy(self, p):
+        num_targets = len(self.target_possible_values)
+        num_rows = self.feature_offsets[-1]
+
+        # count one feature at a time so the temporary arrays stay the size of a single column
+        table = np.zeros((num_rows, num_targets), dtype=np.intp)
+        for feature in features:
+            start, end = self.feature_offsets[feature], self.feature_offsets[feature + 1]
+            cells = codes[rows, feature].astype(np.intp) * num_targets + target_codes
+            table[start:end] = np.bincount(cells, minlength=(end - start) * num_targets).reshape(-1, num_targets)
+        return table
+
+    def calc_split_entropies(self, table, num_records):
         """
-        Returns the entropy value for the given proportion or probability
-        :param p:
+        Calculates the total entropy value of the resulting sets created by splitting the initial set
+        by each feature, given the contingency table from count_targets
+        :param table:
+        :param num_records:
         :return:
         """
-        if p != 0:
-            return -p * np.log2(p)
-        else:
-            return 0
+        # entropy of the targets for each attribute value, scaled by the number of occurrences of the value
+        totals = table.sum(axis=1)
+        proportions = table / np.maximum(totals, 1)[:, np.newaxis]
+        entropy = self.calc_entropy(proportions).sum(axis=1) * totals / num_records
 
-    def get_target_map(self):
+        # add up the values belonging to each feature
+        return np.bincount(self.feature_of_row, weights=entropy, minlength=len(self.feature_values))
+
+    def calc_entropy(self, p):
         """
-        Returns a new map with all possible targets values as the keys and 0 as the value
+        Returns the entropy values for the given array of proportions or probabilities
+        :param p:
         :return:
         """
-        map = {}
-        for val in self.target_possible_values:
-            map[val] = 0
-
-        return map
+        p = np.asarray(p, dtype=float)
+        return -p * np.log2(np.where(p > 0, p, 1))
 
 
 class ID3Node:
@@ -314,93 +893,317 @@ class ID3Node:
         self.default_value = 0
 
 
+########################################################################################
+# RandomForest
+# Trains num_trees ID3 trees, each on a bootstrap sample of the training rows and
+# choosing every split from max_features random features (the square root of the
+# number of features by default). The trees are trained across n_jobs processes and
+# predict by majority vote.
+########################################################################################
+worker_forest_data = None
+
+
+def init_forest_worker(attributes, targets, max_features):
+    global worker_forest_data
+    worker_forest_data = (attributes, targets, max_features)
+
+
+def train_forest_tree(seed):
+    """
+    Trains one tree of a RandomForest on a bootstrap sample of the data given to init_forest_worker
+    :param seed:
+    :return:
+    """
+    attributes, targets, max_features = worker_forest_data
+    rng = np.random.RandomState(seed)
+    rows = rng.randint(len(attributes), size=len(attributes))
+
+    tree = ID3(keep_nodes=False, max_features=max_features, seed=rng.randint(2 ** 31 - 1))
+    tree.train(attributes[rows], targets[rows])
+    # only the compiled tree is needed to predict, so don't send the sample back
+    tree.attributes = []
+    tree.targets = []
+    return tree
+
+
+class RandomForest:
+    def __init__(self, num_trees=10, max_features=None, n_jobs=1, seed=None):
+        self.num_trees = num_trees
+        self.max_features = max_features
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.trees = []
+        self.target_possible_values = []
+
+    def train(self, attributes, targets):
+        attributes = np.asarray(attributes, dtype=float)
+        targets = np.asarray(targets, dtype=float)
+        self.target_possible_values = np.unique(targets[:, 0])
+
+        max_features = self.max_features
+        if max_features is None:
+            max_features = max(1, int(math.ceil(math.sqrt(attributes.shape[1]))))
+
+        seeds = np.random.RandomState(self.seed).randint(2 ** 31 - 1, size=self.num_trees).tolist()
+        n_jobs = multiprocessing.cpu_count() if self.n_jobs < 0 else self.n_jobs
+        n_jobs = min(n_jobs, self.num_trees)
+        profiler.count("forest.trees", self.num_trees)
+        if n_jobs > 1:
+            # the trees are timed as a whole since the workers aren't profiled
+            with profiler.timer("forest.train_trees"):
+                with multiprocessing.Pool(n_jobs, initializer=init_forest_worker,
+                                          initargs=(attributes, targets, max_features)) as pool:
+                    self.trees = pool.map(train_forest_tree, seeds)
+        else:
+            init_forest_worker(attributes, targets, max_features)
+            self.trees = [train_forest_tree(seed) for seed in seeds]
+            init_forest_worker(None, None, None)
+
+    def predict(self, attributes):
+        if self.n_jobs != 1:
+            return parallel_predict(self, attributes, self.n_jobs)
+        return self.predict_serial(attributes)
+
+    def predict_serial(self, attributes):
+        attributes = np.asarray(attributes, dtype=float)
+        rows = np.arange(len(attributes))
+
+        # count the votes for each target value. Ties go to the smallest target value.
+        votes = np.zeros((len(attributes), len(self.target_possible_values)), dtype=np.intp)
+        for tree in self.trees:
+            predicts = np.asarray(tree.predict_serial(attributes))
+            votes[rows, np.searchsorted(self.target_possible_values, predicts)] += 1
+
+        return self.target_possible_values[np.argmax(votes, axis=1)].tolist()
+
+
 ########################################################################################
 # Perceptron
-# A neural network
+# A neural network. Each layer holds a single weight matrix and the rows are pushed
+# through the network batch_size at a time, one matrix multiply per layer.
+#
+# Training runs for at most max_epochs. When validation is set that percentage of the
+# training rows is held out, and training stops once the validation accuracy hasn't
+# improved for patience epochs, keeping the weights from the best epoch. Without a
+# validation set patience watches the training accuracy instead. After every epoch
+# callback is called with the epoch number and a dict of metrics.
+#
+# Each output node stands for one of the target values seen in training, in sorted
+# order, so the targets can be any numbers. predict returns the target values.
+#
+# dtype sets the precision of the weights, activations and inputs (numpy.float32 or
+# numpy.float64). seed can be an int or a numpy Generator, and is used for both the
+# initial weights and the shuffling, so a seeded run can be reproduced exactly.
 ########################################################################################
 class Perceptron:
-    def __init__(self, learning_rate=.1, nodes_per_layer=list()):
+    def __init__(self, learning_rate=.1, nodes_per_layer=list(), batch_size=1, max_epochs=300,
+                 validation=0, patience=None, callback=None, dtype=np.float64, seed=None):
         self.node_layers = []
         self.num_targets = 0
+        self.target_values = []
         self.num_attributes = 0
         self.learning_rate = learning_rate
         self.bias = 1
         self.nodes_per_layer = nodes_per_layer
+        self.batch_size = batch_size
+        self.max_epochs = max_epochs
+        self.validation = validation
+        self.patience = patience
+        self.callback = callback
+        self.epochs_trained = 0
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.default_rng(seed)
 
     def train(self, attributes, targets):
-        self.num_targets = len(np.unique(targets.ravel()))
+        # train on the index of each target value, so the targets don't have to be 0 to n - 1
+        self.target_values, targets = np.unique(np.asarray(targets).ravel(), return_inverse=True)
+        self.num_targets = len(self.target_values)
         self.num_attributes = len(attributes[0])
 
         # create the hidden layers
         for idx in range(len(self.nodes_per_layer)):
             if idx == 0:
-                self.node_layers.append(NodeLayer(self.nodes_per_layer[idx],
-                                                  self.num_attributes + 1, self.learning_rate))
+                self.node_layers.append(NodeLayer(self.nodes_per_layer[idx], self.num_attributes + 1,
+                                                  self.learning_rate, self.rng, self.dtype))
             else:
-                self.node_layers.append(NodeLayer(self.nodes_per_layer[idx],
-                                                  self.nodes_per_layer[idx - 1] + 1, self.learning_rate))
+                self.node_layers.append(NodeLayer(self.nodes_per_layer[idx], self.nodes_per_layer[idx - 1] + 1,
+                                                  self.learning_rate, self.rng, self.dtype))
 
         # create the output layer
         if len(self.node_layers) == 0:
             # if this is the only layer then the number of inputs is equal to the number of attributes + 1
-            self.node_layers.append(NodeLayer(self.num_targets, self.num_attributes + 1, self.learning_rate))
+            self.node_layers.append(NodeLayer(self.num_targets, self.num_attributes + 1, self.learning_rate,
+                                              self.rng, self.dtype))
         else:
             # else the number of inputs is equal to the number of nodes in the last hidden layer + 1
             self.node_layers.append(NodeLayer(self.num_targets,
                                               self.nodes_per_layer[len(self.nodes_per_layer) - 1] + 1,
-                                              self.learning_rate))
+                                              self.learning_rate, self.rng, self.dtype))
+
+        # split into training and validation set. Each set is copied once into an array with
+        # the bias input already appended, so rows can be fed to the network without np.append.
+        num_in_split = len(attributes) * self.validation // 100
+        v_inputs, v_targets, v_expected = self.prepare_rows(attributes[:num_in_split], targets[:num_in_split])
+        t_inputs, t_targets, t_expected = self.prepare_rows(attributes[num_in_split:], targets[num_in_split:])
+        self.allocate(max(self.batch_size, 256))
 
-        # split into training and validation set
-        # num_in_split = len(attributes) * 33 // 100
-        # v_attributes = attributes[:num_in_split]
-        # t_attributes = attributes[num_in_split:]
-        # v_targets = targets[:num_in_split]
-        # t_targets = targets[num_in_split:]
+        best_accuracy = -1.0
+        best_weights = [np.empty_like(node_layer.weights) for node_layer in self.node_layers]
+        saved_best = False
+        epochs_since_best = 0
+        order = np.arange(len(t_inputs))
 
         # start the learning process
-        for i in range(300):
-            # randomize the order each iteration
-            zipped = list(zip(attributes, targets))
-            random.shuffle(zipped)
-            attributes, targets = zip(*zipped)
+        for i in range(self.max_epochs):
+            # randomize the order each iteration by shuffling the same index array in place
+            self.rng.shuffle(order)
 
             num_right = 0
+            with profiler.timer("perceptron.epoch"):
+                for start in range(0, len(order), self.batch_size):
+                    num_right += self.train_batch(t_inputs, t_targets, t_expected, order[start:start + self.batch_size])
+            profiler.count("perceptron.epochs")
+            profiler.count("perceptron.rows_trained", len(order))
+
+            self.epochs_trained = i + 1
+            metrics = {"train_accuracy": num_right / len(order) * 100}
+            accuracy = metrics["train_accuracy"]
+            if num_in_split > 0:
+                with profiler.timer("perceptron.validate"):
+                    metrics["validation_accuracy"] = self.count_correct(v_inputs, v_targets) / num_in_split * 100
+                accuracy = metrics["validation_accuracy"]
+            if self.callback is not None:
+                self.callback(i, metrics)
+
+            # remember the best weights so far and stop once they stop improving
+            if accuracy > best_accuracy:
+                best_accuracy = accuracy
+                epochs_since_best = 0
+                if num_in_split > 0:
+                    for node_layer, weights in zip(self.node_layers, best_weights):
+                        np.copyto(weights, node_layer.weights)
+                    saved_best = True
+            else:
+                epochs_since_best += 1
+                if self.patience is not None and epochs_since_best >= self.patience:
+                    break
+
+        if saved_best:
+            for node_layer, weights in zip(self.node_layers, best_weights):
+                np.copyto(node_layer.weights, weights)
+
+    def prepare_rows(self, attributes, targets):
+        """
+        Returns the attributes with a bias column appended, the target indices, and the expected
+        output of every node of the output layer for each row
+        :param attributes:
+        :param targets: index of each row's target in target_values
+        :return:
+        """
+        inputs = np.empty((len(attributes), self.num_attributes + 1), dtype=self.dtype)
+        inputs[:, :self.num_attributes] = attributes
+        inputs[:, self.num_attributes] = self.bias
+
+        target_idx = np.asarray(targets).ravel().astype(np.intp)
+        expected = np.zeros((len(attributes), self.num_targets), dtype=self.dtype)
+        expected[np.arange(len(attributes)), target_idx] = 1
 
-            for idx, attr in enumerate(attributes):
-                predict = self.feed_forward(attr)
-                self.back_propagate(targets[idx][0])
+        return inputs, target_idx, expected
 
-                # did we get it right?
-                if predict == targets[idx][0]:
-                    num_right += 1
+    def allocate(self, rows):
+        """
+        Allocates the buffers used to push up to rows rows through the network at once
+        :param rows:
+        :return:
+        """
+        self.input_buffer = np.empty((rows, self.num_attributes + 1), dtype=self.dtype)
+        self.input_buffer[:, self.num_attributes] = self.bias
+        self.expected_buffer = np.empty((rows, self.num_targets), dtype=self.dtype)
+        self.target_buffer = np.empty(rows, dtype=np.intp)
+        self.predict_buffer = np.empty(rows, dtype=np.intp)
+        self.correct_buffer = np.empty(rows, dtype=bool)
+        for node_layer in self.node_layers:
+            node_layer.allocate(rows, self.bias)
 
-            print(str(num_right / len(attributes) * 100))
+    def train_batch(self, inputs, targets, expected, rows):
+        """
+        Runs one step of back propagation on the given rows and returns how many of them were
+        predicted correctly before the weights were adjusted
+        :param inputs:
+        :param targets:
+        :param expected:
+        :param rows:
+        :return:
+        """
+        count = len(rows)
+        batch_inputs = self.input_buffer[:count]
+        batch_expected = self.expected_buffer[:count]
+        batch_targets = self.target_buffer[:count]
+        np.take(inputs, rows, axis=0, out=batch_inputs, mode="clip")
+        np.take(expected, rows, axis=0, out=batch_expected, mode="clip")
+        np.take(targets, rows, out=batch_targets, mode="clip")
+
+        predict = self.predict_buffer[:count]
+        with profiler.timer("perceptron.epoch.feed_forward"):
+            self.feed_forward(batch_inputs, predict)
+        with profiler.timer("perceptron.epoch.back_propagate"):
+            self.back_propagate(batch_expected)
+
+        # did we get it right?
+        correct = self.correct_buffer[:count]
+        np.equal(predict, batch_targets, out=correct)
+        return np.count_nonzero(correct)
+
+    def count_correct(self, inputs, targets):
+        """
+        Returns how many of the bias-augmented input rows are predicted as their target
+        :param inputs:
+        :param targets:
+        :return:
+        """
+        num_right = 0
+        rows = len(self.input_buffer)
+        for start in range(0, len(inputs), rows):
+            count = min(rows, len(inputs) - start)
+            predict = self.predict_buffer[:count]
+            correct = self.correct_buffer[:count]
+            self.feed_forward(inputs[start:start + count], predict)
+            np.equal(predict, targets[start:start + count], out=correct)
+            num_right += np.count_nonzero(correct)
+        return num_right
 
     def predict(self, attributes):
-        predicts = [None] * len(attributes)
-        for idx, val in enumerate(attributes):
-            predicts[idx] = self.feed_forward(attributes[idx])
+        profiler.count("perceptron.rows_predicted", len(attributes))
+        attributes = np.asarray(attributes)
+        predicts = np.empty(len(attributes), dtype=np.intp)
 
-        return predicts
+        # copy the rows into the input buffer, which already holds the bias column
+        rows = len(self.input_buffer)
+        for start in range(0, len(attributes), rows):
+            count = min(rows, len(attributes) - start)
+            self.input_buffer[:count, :self.num_attributes] = attributes[start:start + count]
+            self.feed_forward(self.input_buffer[:count], predicts[start:start + count])
 
-    def feed_forward(self, input_row):
-        layer_output = []
-        for idx in range(len(self.node_layers)):
-            if idx == 0:
-                layer_output = self.node_layers[idx]\
-                    .process(np.append(input_row, [self.bias]))
-            else:
-                layer_output = self.node_layers[idx]\
-                    .process(np.append(layer_output, [self.bias]))
+        return self.target_values[predicts].tolist()
 
-        # return the 0 index of the arg sort because this will correspond to the maximum value
-        # from the output layer
-        val = np.argmax(layer_output)
-        return val
+    def feed_forward(self, input_rows, predicts):
+        """
+        Pushes the bias-augmented input rows through the network and writes the index of the output
+        node with the largest value for each row into predicts
+        :param input_rows:
+        :param predicts:
+        :return:
+        """
+        layer_output = input_rows
+        for node_layer in self.node_layers:
+            layer_output = node_layer.process(layer_output)
+
+        output_layer = self.node_layers[len(self.node_layers) - 1]
+        np.argmax(output_layer.activations[:len(input_rows)], axis=1, out=predicts)
 
-    def back_propagate(self, target):
+    def back_propagate(self, expected):
         # calculate the error on the layer first
-        self.node_layers[len(self.node_layers) - 1].calc_outer(target)
+        self.node_layers[len(self.node_layers) - 1].calc_outer(expected)
 
         # calculate the error on the other layers
         idx = len(self.node_layers) - 2
@@ -413,78 +1216,101 @@ class Perceptron:
             node_layer.back_propagate()
 
 
-class Node:
-    def __init__(self, num_inputs, learning_rate):
-        self.weights = np.random.ranf(num_inputs) - .5
+########################################################################################
+# NodeLayer
+# A layer of sigmoid nodes. Row i of weights holds the input weights of node i, with
+# the weight of the bias input last. All the intermediate values live in buffers made
+# by allocate, and every operation writes into them in place, so training a batch
+# doesn't allocate any arrays.
+########################################################################################
+class NodeLayer:
+    def __init__(self, num_nodes, num_inputs, learning_rate, rng=None, dtype=np.float64):
+        rng = np.random.default_rng(rng)
+        self.weights = (rng.random((num_nodes, num_inputs)) - .5).astype(dtype)
         self.learning_rate = learning_rate
-        self.output = 0.0
-        self.error = 0.0
-        self.last_weight_change = [0.0] * num_inputs
+        self.last_weight_change = np.zeros((num_nodes, num_inputs), dtype=dtype)
+        self.weight_change = np.zeros((num_nodes, num_inputs), dtype=dtype)
+        self.gradient = np.zeros((num_nodes, num_inputs), dtype=dtype)
         self.weight_constant = .9
+        self.num_nodes = num_nodes
+        self.count = 0
+        self.inputs = None
 
-    def process(self, inputs):
-        dot_product = np.dot(self.weights, inputs)
+    def allocate(self, rows, bias):
+        """
+        Allocates buffers for up to rows rows. outputs holds the activations followed by a bias
+        column so it can be used directly as the input of the next layer.
+        :param rows:
+        :param bias:
+        :return:
+        """
+        dtype = self.weights.dtype
+        self.activations = np.empty((rows, self.num_nodes), dtype=dtype)
+        self.outputs = np.empty((rows, self.num_nodes + 1), dtype=dtype)
+        self.outputs[:, self.num_nodes] = bias
+        self.errors = np.empty((rows, self.num_nodes), dtype=dtype)
+        self.scratch = np.empty((rows, self.num_nodes), dtype=dtype)
+        self.weighted_sums = np.empty((rows, self.weights.shape[1]), dtype=dtype)
 
-        self.output = 1.0 / (1.0 + math.exp(-dot_product))
+    def process(self, inputs):
+        self.inputs = inputs  # save the inputs so they can be used for error calculation
+        self.count = len(inputs)
 
-        return self.output
+        # sigmoid of the weighted inputs: 1 / (1 + e^-x)
+        activations = self.activations[:self.count]
+        np.dot(inputs, self.weights.T, out=activations)
+        np.negative(activations, out=activations)
+        np.exp(activations, out=activations)
+        activations += 1.0
+        np.reciprocal(activations, out=activations)
 
-    def adjust_weights(self, inputs):
-        # adjust the weight for each inputs by the function:
-        #   w(i,j) = w(i,j) - learning_rate * error_rate * output[i]
-        for idx, val in enumerate(self.weights):
-            weight_change = -(self.learning_rate * self.error * inputs[idx] +
-                              self.weight_constant * self.last_weight_change[idx])
-            self.weights[idx] += weight_change
-            self.last_weight_change[idx] = weight_change
+        outputs = self.outputs[:self.count]
+        outputs[:, :self.num_nodes] = activations
+        return outputs
 
-    def calc_outer_error(self, target):
+    def calc_derivative(self):
         """
-        Sets the error value for this node based on the given target value
-        :param target:
+        Returns the derivative of the sigmoid, output * (1 - output), for the current batch
         :return:
         """
-        self.error = self.output * (1 - self.output) * (self.output - target)
+        activations = self.activations[:self.count]
+        derivative = self.scratch[:self.count]
+        np.subtract(1.0, activations, out=derivative)
+        derivative *= activations
+        return derivative
 
-    def calc_hidden_error(self, index, node_layer):
+    def calc_outer(self, expected):
         """
-        Sets the error value for this node based on the given set of nodes in the next node layer
-        :param index:
-        :param node_layer:
+        Sets the error values of this layer for the given batch of expected outputs
+        :param expected:
         :return:
         """
-        weighted_sum = 0.0
-        for node in node_layer.nodes:
-            weighted_sum += node.error * node.weights[index]
+        errors = self.errors[:self.count]
+        np.subtract(self.activations[:self.count], expected, out=errors)
+        errors *= self.calc_derivative()
 
-        self.error = self.output * (1 - self.output) * weighted_sum
-
-
-class NodeLayer:
-    def __init__(self, num_nodes, num_inputs, learning_rate):
-        self.nodes = [None] * num_nodes
-        self.inputs = []
-        # init each node
-        for idx, val in enumerate(self.nodes):
-            self.nodes[idx] = Node(num_inputs, learning_rate)
-
-    def process(self, inputs):
-        self.inputs = inputs  # save the inputs so they can be used for error calculation
-        output = [node.process(inputs) for node in self.nodes]
-
-        return output
-
-    def calc_outer(self, target):
-        for idx, node in enumerate(self.nodes):
-            if idx == target:
-                node.calc_outer_error(1)
-            else:
-                node.calc_outer_error(0)
-
-    def calc_hidden(self, prev_node_layer):
-        for idx, node in enumerate(self.nodes):
-            node.calc_hidden_error(idx, prev_node_layer)
+    def calc_hidden(self, next_layer):
+        """
+        Sets the error values of this layer based on the errors and weights of the next node layer. The
+        weights of the next layer's bias input aren't connected to this layer.
+        :param next_layer:
+        :return:
+        """
+        weighted_sum = next_layer.weighted_sums[:self.count]
+        np.dot(next_layer.errors[:self.count], next_layer.weights, out=weighted_sum)
+        np.multiply(self.calc_derivative(), weighted_sum[:, :self.num_nodes], out=self.errors[:self.count])
 
     def back_propagate(self):
-        for node in self.nodes:
-            node.adjust_weights(self.inputs)
+        # adjust the weights by the function:
+        #   w(i,j) = w(i,j) - learning_rate * error_rate * output[i]
+        # summing the change over the rows of the batch. The sum isn't averaged, so the step
+        # grows with batch_size and a larger batch may need a smaller learning rate.
+        np.dot(self.errors[:self.count].T, self.inputs, out=self.gradient)
+        self.gradient *= self.learning_rate
+        np.multiply(self.last_weight_change, self.weight_constant, out=self.weight_change)
+        self.weight_change += self.gradient
+        np.negative(self.weight_change, out=self.weight_change)
+        self.weights += self.weight_change
+
+        # the change just made becomes the last change for the next step
+        self.last_weight_change, self.weight_change = self.weight_change, self.last_weight_change
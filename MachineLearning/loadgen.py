@@ -0,0 +1,222 @@
+import sys
+import getopt
+import asyncio
+import csv
+import json
+import os
+import subprocess
+import time
+import numpy
+
+
+########################################################################################
+# Load generator
+# Sends predict requests to server.py from many concurrent connections and reports the
+# throughput and latency seen by the clients, along with the server's own metrics.
+#
+# Either runs against a server which is already listening, or, when --load-model and
+# --windows are given, starts a server for each batch window in turn so the
+# latency/throughput tradeoff of the window can be compared in one table.
+########################################################################################
+async def open_connection(host, port, unix_path):
+    if unix_path is not None:
+        return await asyncio.open_unix_connection(unix_path)
+    return await asyncio.open_connection(host, port)
+
+
+async def request(reader, writer, method, path, body=b""):
+    """
+    Sends one HTTP/1.1 request on an open connection and reads the response
+    :param reader:
+    :param writer:
+    :param method:
+    :param path:
+    :param body:
+    :return: status code and response body
+    """
+    writer.write((method + " " + path + " HTTP/1.1\r\nHost: localhost\r\nContent-Length: " + str(len(body)) +
+                  "\r\n\r\n").encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def run_client(bodies, start, step, count, host, port, unix_path, latencies, failures):
+    """
+    Sends count requests over one connection, one after another, taking every step'th body
+    :return:
+    """
+    reader, writer = await open_connection(host, port, unix_path)
+    try:
+        for idx in range(count):
+            sent = time.perf_counter()
+            status, response = await request(reader, writer, "POST", "/predict",
+                                             bodies[(start + idx * step) % len(bodies)])
+            if status == 200:
+                latencies.append(time.perf_counter() - sent)
+            else:
+                failures.append(response)
+    finally:
+        writer.close()
+
+
+async def generate_load(bodies, num_requests, concurrency, host, port, unix_path):
+    """
+    Spreads num_requests requests over concurrency connections
+    :return: map of the client side results and the server's metrics afterwards
+    """
+    latencies = []
+    failures = []
+    per_client = [num_requests // concurrency + (idx < num_requests % concurrency) for idx in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*[run_client(bodies, idx, concurrency, count, host, port, unix_path, latencies, failures)
+                           for idx, count in enumerate(per_client) if count])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await open_connection(host, port, unix_path)
+    try:
+        metrics = json.loads((await request(reader, writer, "GET", "/metrics"))[1])
+    finally:
+        writer.close()
+
+    latencies = numpy.array(latencies) * 1000
+    p50, p99 = numpy.percentile(latencies, [50, 99]).tolist() if len(latencies) else (0.0, 0.0)
+    return {
+        "requests": len(latencies),
+        "failures": len(failures),
+        "requests_per_s": len(latencies) / elapsed,
+        "client_p50_ms": p50,
+        "client_p99_ms": p99,
+        "server": metrics,
+    }
+
+
+def read_bodies(file_path, rows_per_request):
+    """
+    Reads the rows of a csv file into request bodies of rows_per_request rows each
+    :param file_path:
+    :param rows_per_request:
+    :return:
+    """
+    with open(file_path, "rt", newline="") as csv_file:
+        lines = [",".join(row) for row in csv.reader(csv_file) if row]
+    return ["\n".join(lines[start:start + rows_per_request]).encode()
+            for start in range(0, len(lines), rows_per_request)]
+
+
+def start_server(model, port, unix_path, batch_window, max_batch):
+    """
+    Starts server.py in a new process and waits until it's listening
+    :return: the process
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+               "--load-model=" + model, "--port=" + str(port), "--batch-window=" + str(batch_window),
+               "--max-batch=" + str(max_batch)]
+    if unix_path is not None:
+        command.append("--unix=" + unix_path)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith("Serving"):
+        process.kill()
+        raise RuntimeError("Server didn't start: " + line)
+    return process
+
+
+def print_results(window, results):
+    server = results["server"]
+    print(str(window).rjust(10), ("%.0f" % results["requests_per_s"]).rjust(10),
+          ("%.2f" % results["client_p50_ms"]).rjust(10), ("%.2f" % results["client_p99_ms"]).rjust(10),
+          ("%.2f" % server["latency_p50_ms"]).rjust(10), ("%.2f" % server["latency_p99_ms"]).rjust(10),
+          ("%.1f" % server["mean_batch_size"]).rjust(10), ("%.1f" % server["mean_queue_depth"]).rjust(10),
+          str(server["max_queue_depth"]).rjust(10), str(results["failures"]).rjust(9))
+
+
+def main(argv):
+    usage = "\tusage: --data=[csv_file] --host=[address] --port=[port] --unix=[socket_path] \
+            --requests=[num_requests] --concurrency=[connections] --rows-per-request=[rows] \
+            --load-model=[directory] --windows=[ms1,ms2,etc] --max-batch=[rows] (start a server per window) \
+            --output=[json_file]"
+
+    opts, args = getopt.getopt(argv[1:], "h", ["help", "data=", "host=", "port=", "unix=", "requests=", "concurrency=",
+                                               "rows-per-request=", "load-model=", "windows=", "max-batch=",
+                                               "output="])
+    data = None
+    host = "127.0.0.1"
+    port = 8450
+    unix_path = None
+    num_requests = 2000
+    concurrency = 32
+    rows_per_request = 1
+    model = None
+    windows = None
+    max_batch = 256
+    output = None
+
+    for key, val in opts:
+        if key in ("-h", "--help"):
+            print(usage)
+            sys.exit()
+        elif key == "--data":
+            data = val
+        elif key == "--host":
+            host = val
+        elif key == "--port":
+            port = int(val)
+        elif key == "--unix":
+            unix_path = val
+        elif key == "--requests":
+            num_requests = int(val)
+        elif key == "--concurrency":
+            concurrency = int(val)
+        elif key == "--rows-per-request":
+            rows_per_request = int(val)
+        elif key == "--load-model":
+            model = val
+        elif key == "--windows":
+            windows = [float(window) for window in val.split(",")]
+        elif key == "--max-batch":
+            max_batch = int(val)
+        elif key == "--output":
+            output = val
+        else:
+            assert False, "unhandled option"
+
+    if data is None:
+        print("No data set specified")
+        sys.exit(1)
+    bodies = read_bodies(data, rows_per_request)
+
+    print("window ms".rjust(10), "req/s".rjust(10), "client p50".rjust(10), "client p99".rjust(10),
+          "server p50".rjust(10), "server p99".rjust(10), "batch".rjust(10), "mean queue".rjust(10),
+          "max queue".rjust(10), "failures".rjust(9))
+    all_results = []
+    if model is not None and windows is not None:
+        for window in windows:
+            process = start_server(model, port, unix_path, window, max_batch)
+            try:
+                results = asyncio.run(generate_load(bodies, num_requests, concurrency, host, port, unix_path))
+            finally:
+                process.terminate()
+                process.wait()
+            results["batch_window_ms"] = window
+            print_results(window, results)
+            all_results.append(results)
+    else:
+        results = asyncio.run(generate_load(bodies, num_requests, concurrency, host, port, unix_path))
+        print_results("-", results)
+        all_results.append(results)
+
+    if output is not None:
+        with open(output, "wt") as out:
+            json.dump(all_results, out, indent=1)
+
+if __name__ == "__main__":
+    main(sys.argv)
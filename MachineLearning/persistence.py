@@ -0,0 +1,165 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy
+import classifier
+import preprocessor
+
+FORMAT_VERSION = 1
+
+
+########################################################################################
+# persistence
+# Saves a trained ID3, KNearestNeighbor or Perceptron together with the RowTransform
+# of its DataSet, so raw rows can be predicted later without the training csv or
+# training again.
+#
+# A saved model is a directory holding a manifest.json and one .npy file per array:
+#   - manifest.json - format_version, the classifier's type and settings, and the
+#                     RowTransform state (encoder categories, bin edges, scaler stats)
+#   - *.npy - the classifier's arrays, written as they are stored in memory
+#
+# The .npy files are loaded memory mapped, so a KNearestNeighbor's training data is
+# paged in from disk as it's used rather than read in full up front. Models are written
+# to a temporary directory first and moved into place, so a directory is never left
+# half written. Loading a directory written with a different format_version raises a
+# ValueError.
+########################################################################################
+def save_model(directory, net, transform):
+    """
+    Writes net and the RowTransform used to prepare its rows to directory, replacing any model
+    already there. Raises a ValueError if directory exists and holds anything but a saved model,
+    so nothing else is ever deleted.
+    :param directory:
+    :param net: a trained ID3, KNearestNeighbor or Perceptron
+    :param transform:
+    :return:
+    """
+    if isinstance(net, classifier.ID3):
+        kind = "ID3"
+        settings = dict(n_jobs=net.n_jobs)
+        arrays = dict(target_possible_values=net.target_possible_values,
+                      feature_values=numpy.concatenate(net.feature_values) if net.feature_values else numpy.empty(0),
+                      feature_offsets=numpy.cumsum([0] + [len(values) for values in net.feature_values]),
+                      node_feature=net.node_feature, node_value=net.node_value,
+                      branch_start=net.branch_start, branches=net.branches)
+    elif isinstance(net, classifier.KNearestNeighbor):
+        kind = "KNN"
+        settings = dict(k=net.k, chunk_size=net.chunk_size, index=net.index, leaf_size=net.leaf_size,
+                        weighted=net.weighted, n_jobs=net.n_jobs, lsh_tables=net.lsh_tables,
+                        lsh_hashes=net.lsh_hashes, seed=net.seed)
+        arrays = dict(attributes=net.attributes, targets=net.targets,
+                      mapped=numpy.asarray(net.mapped, dtype=bool))
+    elif isinstance(net, classifier.Perceptron):
+        kind = "Perceptron"
+        settings = dict(learning_rate=net.learning_rate, nodes_per_layer=list(net.nodes_per_layer),
+                        batch_size=net.batch_size, dtype=net.dtype.str, num_targets=net.num_targets,
+                        num_attributes=net.num_attributes, bias=net.bias)
+        arrays = {"weights_" + str(idx): node_layer.weights for idx, node_layer in enumerate(net.node_layers)}
+        arrays["target_values"] = net.target_values
+    else:
+        raise ValueError("Can't save a " + type(net).__name__)
+
+    check_model_directory(directory)
+
+    manifest = dict(format_version=FORMAT_VERSION, classifier=kind, settings=settings,
+                    arrays=sorted(arrays), transform=transform.get_state())
+
+    # write everything next to the destination, then swap it in
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temp_path = tempfile.mkdtemp(prefix=".model-", dir=parent)
+    os.chmod(temp_path, 0o755)
+    try:
+        for name, array in arrays.items():
+            numpy.save(os.path.join(temp_path, name + ".npy"), numpy.ascontiguousarray(array))
+        with open(os.path.join(temp_path, "manifest.json"), "wt") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.replace(temp_path, directory)
+    except BaseException:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+
+def check_model_directory(directory):
+    """
+    Raises a ValueError unless directory can be written by save_model: it doesn't exist yet, is
+    empty, or holds a saved model
+    :param directory:
+    :return:
+    """
+    if os.path.exists(directory) and not is_model_directory(directory) and (
+            not os.path.isdir(directory) or os.listdir(directory)):
+        raise ValueError(directory + " already exists and isn't a saved model, not replacing it")
+
+
+def is_model_directory(directory):
+    """
+    Returns True when directory holds a manifest.json written by save_model
+    :param directory:
+    :return:
+    """
+    try:
+        with open(os.path.join(directory, "manifest.json"), "rt") as manifest_file:
+            return "format_version" in json.load(manifest_file)
+    except (OSError, ValueError, TypeError):
+        return False
+
+
+def load_model(directory, n_jobs=None):
+    """
+    Reads a model written by save_model
+    :param directory:
+    :param n_jobs: overrides the number of processes the classifier predicts with
+    :return: the classifier and its RowTransform
+    """
+    with open(os.path.join(directory, "manifest.json"), "rt") as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError("Model in " + directory + " has format version " + str(manifest.get("format_version")) +
+                         ", expected " + str(FORMAT_VERSION))
+
+    arrays = {name: numpy.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+              for name in manifest["arrays"]}
+    settings = manifest["settings"]
+    if n_jobs is not None and "n_jobs" in settings:
+        settings["n_jobs"] = n_jobs
+    kind = manifest["classifier"]
+
+    if kind == "ID3":
+        net = classifier.ID3(n_jobs=settings["n_jobs"], keep_nodes=False)
+        offsets = arrays["feature_offsets"]
+        values = numpy.array(arrays["feature_values"])
+        net.feature_values = [values[offsets[idx]:offsets[idx + 1]] for idx in range(len(offsets) - 1)]
+        net.target_possible_values = numpy.array(arrays["target_possible_values"])
+        for name in ("node_feature", "node_value", "branch_start", "branches"):
+            setattr(net, name, numpy.array(arrays[name]))
+    elif kind == "KNN":
+        net = classifier.KNearestNeighbor(**settings)
+        # the training rows stay memory mapped; an index is rebuilt over them
+        net.train(arrays["attributes"], arrays["targets"], arrays["mapped"].tolist())
+    elif kind == "Perceptron":
+        net = classifier.Perceptron(learning_rate=settings["learning_rate"],
+                                    nodes_per_layer=settings["nodes_per_layer"],
+                                    batch_size=settings["batch_size"], dtype=settings["dtype"])
+        net.num_targets = settings["num_targets"]
+        net.num_attributes = settings["num_attributes"]
+        net.bias = settings["bias"]
+        if "target_values" in arrays:
+            net.target_values = numpy.array(arrays["target_values"])
+        else:
+            net.target_values = numpy.arange(net.num_targets)
+        for idx in range(len(settings["nodes_per_layer"]) + 1):
+            weights = numpy.array(arrays["weights_" + str(idx)])
+            node_layer = classifier.NodeLayer(weights.shape[0], weights.shape[1], net.learning_rate, dtype=net.dtype)
+            node_layer.weights = weights
+            net.node_layers.append(node_layer)
+        net.allocate(max(net.batch_size, 256))
+    else:
+        raise ValueError("Unrecognized classifier in " + directory + ": " + str(kind))
+
+    transform = preprocessor.RowTransform(**manifest["transform"])
+    return net, transform
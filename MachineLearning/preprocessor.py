@@ -1,7 +1,15 @@
 import csv
+import hashlib
+import itertools
+import json
 import numpy
-import random
-import sys
+import os
+import profiler
+import shutil
+
+
+# bump whenever the layout of the cache entries changes
+CACHE_VERSION = 3
 
 
 ########################################################################################
@@ -18,6 +26,17 @@ import sys
 #   - ignore - array of columns in the data set to ignore
 #   - mapped - array of columns in the data set to be mapped from string values to integer values
 #   - norm - True or False - should non-mapped values be normalized?
+#   - norm_in_place - normalize data_array itself rather than a copy of it
+#   - bins - a map of column number to the number of bins to discretize it into
+#   - bin_strategy - "uniform" for bins of equal width, "quantile" for bins holding an
+#                    equal number of the training rows
+#   - dtype - numpy float type used to store the data (e.g. numpy.float32)
+#   - seed - seed or numpy Generator used to shuffle the rows, None for a random order
+#   - chunk_size - number of rows of the file read and converted at a time
+#   - cache_dir - directory to cache the processed data in. Later runs with the same file
+#                 and options memory map the cached data instead of parsing the file.
+#                 None (the default) turns caching off. Entries are never removed, so delete
+#                 the directory to clear it.
 #
 # Members:
 #   - target_index - index of target column in data set
@@ -30,12 +49,18 @@ import sys
 #                         for each column. Applies to both mapped and ordered columns.
 #   - mappings_to_str - map of integer values to corresponding original string values
 #                       for each column. Applies to both mapped and ordered columns.
+#   - encoders - the fitted CategoricalEncoder for each mapped or ordered column, None
+#                for the other columns. Used to encode new data the same way.
+#   - discretizers - map of binned column number to its fitted Discretizer
 #   - data_array - the entire collection of data (including attributes and targets)
 #                  in numerical form.
 #   - attributes - the attributes of the data
 #   - targets - the targets of the data
 #   - data_normal - the entire collection of data after being normalized using z-scores.
-#                   Only mapped columns (unordered) are not normalized.
+#                   Only mapped columns (unordered) are not normalized. The same array
+#                   as data_array when norm_in_place is given.
+#   - scaler - the Scaler fitted on the training rows when norm is given, None otherwise
+#   - ignore, missing - the ignore and missing arguments, kept for row_transform
 #   - attributes_normal - the normalized attributes
 #   - targets_normal - the normalized target values
 #   - train_attributes - the normalized attributes in the training set
@@ -45,94 +70,70 @@ import sys
 ########################################################################################
 class DataSet:
     def __init__(self, file_path, ordered=None, target=-1, split=70, ignore=None, missing='?',
-                 mapped=None, norm=False, bins=None):
-        # load raw data
-        reader = csv.reader(open(file_path, "rt"), delimiter=',')
-        data_list = list(reader)
-
-        # replace any missing values
-        for iRow, row in enumerate(data_list):
-            for iCol, val in enumerate(row):
-                if val == missing:
-                    data_list[iRow][iCol] = 0
-
-        # set target column value
-        if target < 0:
-            self.target_index = len(data_list[0]) - 1  # assume last position is targets
+                 mapped=None, norm=False, bins=None, dtype=numpy.float64, seed=None, chunk_size=10000,
+                 cache_dir=None, bin_strategy="uniform", norm_in_place=False):
+        ordered = dict(ordered or {})
+        ignore = list(ignore or [])
+        mapped = list(mapped or [])
+        bins = dict(bins or {})
+        self.scaler = None
+        self.ignore = ignore
+        self.missing = missing
+
+        # look for the parsed data in the cache. The key covers the contents of the file and
+        # every option which changes the parsed data, so a stale cache is never used.
+        cache_path = None
+        if cache_dir is not None:
+            options = dict(ordered=ordered, target=target, missing=missing, mapped=mapped,
+                           dtype=numpy.dtype(dtype).str)
+            cache_path = os.path.join(cache_dir, self.cache_key(file_path, options))
+
+        if cache_path is not None and os.path.exists(os.path.join(cache_path, "meta.json")):
+            with profiler.timer("dataset.cache_load"):
+                self.load_cache(cache_path)
         else:
-            self.swap_target(data_list, target)
-
-            # swap the ordered parameter if necessary
-            if target in ordered:
-                tmp = ordered[target]
-                ordered.pop(target, None)
-                ordered[len(data_list[0]) - 1] = tmp
-
-            # swap the bin parameter if necessary
-            if target in bins:
-                tmp = bins[target]
-                bins.pop(target, None)
-                bins[len(data_list[0]) - 1] = tmp
-
-            # swap the mapped parameter if necessary
-            last = len(data_list[0]) - 1
-            if target in mapped:
-                # if they're both mapped then nothing needs to be done
-                # if only the target is mapped, then the parameter needs to be "swapped"
-                if last not in mapped:
-                    mapped.pop(target, None)
-                    mapped.append(target)
-            if last in mapped:
-                if target not in mapped:
-                    mapped.pop(last, None)
-                    mapped.append(last)
-
-            self.target_index = last
-
-        # set ordered columns array
-        self.ordered_columns = [False] * len(data_list[0])
-        self.orderings = ordered
-        for key in ordered.keys():
-            self.ordered_columns[key] = True
-
-        # set mapped columns array
-        self.mapped_columns = [False] * len(data_list[0])
-        for val in mapped:
-            self.mapped_columns[val] = True
-
-        # map the columns
-        self.mappings_from_str = [None] * len(data_list[0])
-        self.mappings_to_str = [None] * len(data_list[0])
-        for idx, val in enumerate(data_list[0]):
-            if self.ordered_columns[idx] or self.mapped_columns[idx]:
-                self.map_column(data_list, idx)
-
-        # convert to floats and shuffle
-        random.shuffle(data_list)
-        self.data_array = numpy.array(data_list).astype('float')
-
-        # bin any data necessary
-        for col, num_bins in bins.items():
-            self.discretize(self.data_array, col, num_bins=num_bins)
+            with profiler.timer("dataset.parse"):
+                self.load_csv(file_path, ordered, target, missing, mapped, dtype, chunk_size)
+            if cache_path is not None:
+                with profiler.timer("dataset.cache_save"):
+                    self.save_cache(cache_path)
+        profiler.count("dataset.rows", len(self.data_array))
+
+        # shuffle. A parsed array is shuffled in place. A cached array is memory mapped read only,
+        # so it's read into memory in the shuffled order, which gives the same rows as shuffling.
+        with profiler.timer("dataset.shuffle"):
+            rng = numpy.random.default_rng(seed)
+            if isinstance(self.data_array, numpy.memmap):
+                self.data_array = numpy.ascontiguousarray(self.data_array[rng.permutation(len(self.data_array))])
+            else:
+                rng.shuffle(self.data_array)
+        num_in_split = len(self.data_array) * split // 100
+
+        # bin any data necessary. The bin edges are fitted on the training rows only.
+        self.bins = {self.source_columns[col]: num_bins for col, num_bins in bins.items()}
+        self.discretizers = {}
+        with profiler.timer("dataset.discretize"):
+            for col, num_bins in self.bins.items():
+                self.discretizers[col] = Discretizer(num_bins, bin_strategy).fit(self.data_array[:num_in_split, col])
+                self.data_array[:, col] = self.discretizers[col].transform(self.data_array[:, col])
 
         # "ignore" any given columns
-        self.data_array = self.data_array.transpose()
         for col in ignore:
-            self.data_array[col] = [1] * len(self.data_array[col])
-        self.data_array = self.data_array.transpose()
+            self.data_array[:, col] = 1
 
         # split into targets and attributes
         self.attributes = self.data_array[:, :self.target_index]
         self.targets = self.data_array[:, self.target_index:self.target_index + 1]
 
-        # normalize data
+        # normalize data, using the mean and standard deviation of the training rows
         if norm:
-            self.data_normal = self.normalize(numpy.copy(self.data_array))
+            with profiler.timer("dataset.normalize"):
+                self.scaler = Scaler(self.mapped_columns).fit(self.data_array[:num_in_split])
+                self.data_normal = self.scaler.transform(self.data_array, in_place=norm_in_place)
             self.attributes_normal = self.data_normal[:, :self.target_index]
             self.targets_normal = self.data_normal[:, self.target_index:self.target_index + 1]
 
         # split into training and testing set
-        num_in_split = len(self.data_array) * split // 100
         if norm:
             self.train_attributes = self.attributes_normal[:num_in_split]
             self.test_attributes = self.attributes_normal[num_in_split:]
@@ -144,53 +145,211 @@ class DataSet:
             self.train_targets = self.targets[:num_in_split]
             self.test_targets = self.targets[num_in_split:]
 
-    # map the values of the column to integer values
-    def map_column(self, data_list, column):
-        # init values
-        self.mappings_from_str[column] = {}
-        self.mappings_to_str[column] = {}
-        if not self.ordered_columns[column]:
-            # get unique column values
-            unique_values = set()
-            for idx, val in enumerate(data_list):
-                unique_values.add(data_list[idx][column])
-
-            i = 0
-            for val in unique_values:
-                self.mappings_from_str[column][val] = i
-                self.mappings_to_str[column][i] = val
-                i += 1
-        else:
-            # use the ordering specified
-            i = 0
-            for val in self.orderings[column]:
-                self.mappings_from_str[column][val] = i
-                self.mappings_to_str[column][i] = val
-                i += 1
-
-        # replace column values
-        for idx, val in enumerate(data_list):
-            data_list[idx][column] = self.mappings_from_str[column][data_list[idx][column]]
-
-    # swap the target column with the end column
-    def swap_target(self, data_list, target):
-        end = len(data_list[0]) - 1
-        for idx, val in enumerate(data_list):
-            # swap the values of the target column and end column
-            tmp = data_list[idx][end]
-            data_list[idx][end] = data_list[idx][target]
-            data_list[idx][target] = tmp
-
-    def normalize(self, data):
-        # transpose the data so we can work with rows
-        data = data.transpose()
-
-        # use z scores for each row
-        for idx, val in enumerate(data):
-            if not self.mapped_columns[idx] and data[idx].std() > 0:
-                data[idx] = (data[idx] - data[idx].mean()) / data[idx].std()
-
-        return data.transpose()
+    def row_transform(self):
+        """
+        Returns a RowTransform which prepares new raw rows the same way as this data set
+        :return:
+        """
+        discretizers = {col: (discretizer.num_bins, discretizer.strategy, discretizer.edges.tolist())
+                        for col, discretizer in self.discretizers.items()}
+        scaler = None
+        if self.scaler is not None:
+            scaler = (self.scaler.mean.tolist(), self.scaler.std.tolist())
+        return RowTransform(self.source_columns, self.target_index, self.data_array.dtype.str,
+                            [None if encoder is None else (encoder.categories.tolist(), encoder.unknown)
+                             for encoder in self.encoders],
+                            discretizers, self.ignore, scaler, self.missing)
+
+    def load_csv(self, file_path, ordered, target, missing, mapped, dtype, chunk_size):
+        """
+        Parses the csv file into data_array, moving the target column to the end and mapping any
+        ordered or mapped columns to integers
+        :param file_path:
+        :param ordered:
+        :param target:
+        :param missing:
+        :param mapped:
+        :param dtype:
+        :param chunk_size:
+        :return:
+        """
+        with open(file_path, "rt") as csv_file:
+            reader = csv.reader(csv_file, delimiter=',')
+            first_row = next(reader)
+            num_columns = len(first_row)
+
+            # set target column value
+            last = num_columns - 1
+            self.target_index = last  # the target is always moved to the last position
+            self.source_columns = list(range(num_columns))
+            if 0 <= target != last:
+                # swap the target column with the end column, along with any parameters given for them
+                self.source_columns[target], self.source_columns[last] = last, target
+                ordered = {self.source_columns[col]: val for col, val in ordered.items()}
+                mapped = [self.source_columns[col] for col in mapped]
+
+            # set ordered columns array
+            self.ordered_columns = [False] * num_columns
+            self.orderings = ordered
+            for key in ordered.keys():
+                self.ordered_columns[key] = True
+
+            # set mapped columns array
+            self.mapped_columns = [False] * num_columns
+            for val in mapped:
+                self.mapped_columns[val] = True
+
+            # the encoders are fitted as the chunks are read. Ordered columns have a fixed set of
+            # categories, unordered columns take on any new value they see.
+            self.encoders = [None] * num_columns
+            for idx in range(num_columns):
+                if self.ordered_columns[idx]:
+                    self.encoders[idx] = CategoricalEncoder(self.orderings[idx])
+                elif self.mapped_columns[idx]:
+                    self.encoders[idx] = CategoricalEncoder(unknown="extend")
+
+            # load the rows a chunk at a time into a growing array
+            self.data_array = self.load_rows(itertools.chain([first_row], reader), num_columns, missing,
+                                             dtype, chunk_size)
+
+        # the unordered columns were given codes in the order their values were read, so switch to
+        # the sorted order of the values to keep the mapping the same however the file is chunked.
+        # Once loaded, values that weren't in the file are encoded as -1.
+        for idx in range(num_columns):
+            if self.mapped_columns[idx] and not self.ordered_columns[idx]:
+                new_codes = self.encoders[idx].sort()
+                self.data_array[:, idx] = new_codes[self.data_array[:, idx].astype(numpy.intp)]
+                self.encoders[idx].unknown = -1
+        self.set_mappings()
+
+    def set_mappings(self):
+        """
+        Sets mappings_from_str and mappings_to_str from the fitted encoders
+        :return:
+        """
+        self.mappings_from_str = [None if encoder is None else encoder.mapping() for encoder in self.encoders]
+        self.mappings_to_str = [None if encoder is None else dict(enumerate(encoder.categories.tolist()))
+                                for encoder in self.encoders]
+
+    def load_rows(self, rows, num_columns, missing, dtype, chunk_size):
+        """
+        Reads the rows chunk_size at a time, converting each chunk straight into a numeric array
+        which doubles in size whenever it fills up. Only one chunk of strings is held at a time.
+        :param rows:
+        :param num_columns:
+        :param missing:
+        :param dtype:
+        :param chunk_size:
+        :return:
+        """
+        data = numpy.empty((0, num_columns), dtype=dtype)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            if count + len(chunk) > len(data):
+                data.resize((max(2 * len(data), count + len(chunk)), num_columns), refcheck=False)
+            self.convert_chunk(chunk, data[count:count + len(chunk)], missing)
+            count += len(chunk)
+
+        data.resize((count, num_columns), refcheck=False)
+        return data
+
+    def convert_chunk(self, chunk, out, missing):
+        """
+        Converts a chunk of rows of strings into numbers, writing them into out
+        :param chunk:
+        :param out:
+        :param missing:
+        :return:
+        """
+        columns = list(zip(*chunk))
+        for idx, source in enumerate(self.source_columns):
+            values = numpy.array(columns[source])
+
+            # replace any missing values
+            values[values == missing] = "0"
+
+            if self.encoders[idx] is not None:
+                with profiler.timer("dataset.parse.encode"):
+                    out[:, idx] = self.encoders[idx].transform(values)
+            else:
+                with profiler.timer("dataset.parse.convert"):
+                    out[:, idx] = values.astype(out.dtype)
+
+    def cache_key(self, file_path, options):
+        """
+        Returns the name of the cache entry for the file with the given options, made from a hash
+        of the file's contents and the options
+        :param file_path:
+        :param options:
+        :return:
+        """
+        key = hashlib.sha256()
+        with open(file_path, "rb") as data_file:
+            for block in iter(lambda: data_file.read(1 << 20), b""):
+                key.update(block)
+        key.update(json.dumps([CACHE_VERSION, options], sort_keys=True).encode())
+        return key.hexdigest()[:32]
+
+    def save_cache(self, cache_path):
+        """
+        Writes the processed data column by column to a .npy file, and everything else needed to
+        rebuild the DataSet to a json file. The entry is written to a temporary directory first
+        and renamed into place so a half written entry is never read.
+        :param cache_path:
+        :return:
+        """
+        meta = {
+            "version": CACHE_VERSION,
+            "target_index": self.target_index,
+            "ordered_columns": self.ordered_columns,
+            "mapped_columns": self.mapped_columns,
+            "orderings": [[col, vals] for col, vals in self.orderings.items()],
+            "categories": [None if encoder is None else encoder.categories.tolist() for encoder in self.encoders],
+            "source_columns": self.source_columns,
+        }
+
+        temp_path = cache_path + ".tmp" + str(os.getpid())
+        os.makedirs(temp_path, exist_ok=True)
+        # write the columns one at a time into the file, rather than making a column major copy
+        out = numpy.lib.format.open_memmap(os.path.join(temp_path, "data.npy"), mode="w+",
+                                           dtype=self.data_array.dtype, shape=self.data_array.shape,
+                                           fortran_order=True)
+        for col in range(self.data_array.shape[1]):
+            out[:, col] = self.data_array[:, col]
+        out.flush()
+        del out
+        with open(os.path.join(temp_path, "meta.json"), "wt") as meta_file:
+            json.dump(meta, meta_file)
+        try:
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # another process wrote the same entry first
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def load_cache(self, cache_path):
+        """
+        Restores the processed data from a cache entry written by save_cache. The data is memory
+        mapped rather than read.
+        :param cache_path:
+        :return:
+        """
+        with open(os.path.join(cache_path, "meta.json"), "rt") as meta_file:
+            meta = json.load(meta_file)
+
+        self.data_array = numpy.load(os.path.join(cache_path, "data.npy"), mmap_mode="r")
+        self.target_index = meta["target_index"]
+        self.ordered_columns = meta["ordered_columns"]
+        self.mapped_columns = meta["mapped_columns"]
+        self.orderings = {col: vals for col, vals in meta["orderings"]}
+        self.encoders = [None if categories is None else CategoricalEncoder(categories, unknown=-1)
+                         for categories in meta["categories"]]
+        for col in self.orderings:
+            self.encoders[col].unknown = "error"
+        self.set_mappings()
+        self.source_columns = meta["source_columns"]
 
     # returns if s is a number
     def is_number(self, s):
@@ -200,21 +359,331 @@ class DataSet:
         except ValueError:
             return False
 
-    def discretize(self, data, col, num_bins=3):
-        d_min = sys.float_info.max
-        d_max = sys.float_info.min
 
-        for row in data:
-            if row[col] > d_max:
-                d_max = row[col]
-            elif row[col] < d_min:
-                d_min = row[col]
+########################################################################################
+# RowTransform class
+# Prepares new raw rows, as read from a csv file, the same way a DataSet prepared its
+# data: columns are moved so the target is last, categorical columns are encoded, and
+# the fitted bins, ignored columns and normalization are applied. Everything it needs
+# is json serializable, so it can be saved with a trained classifier and used without
+# the training csv. Get one from DataSet.row_transform().
+#
+# Parameters:
+#   - source_columns - the column of the file that each column of the data comes from
+#   - target_index - index of the target column in the data
+#   - dtype - numpy dtype string of the data
+#   - encoders - (categories, unknown) for each encoded column, None for the others
+#   - discretizers - map of column to (num_bins, strategy, edges)
+#   - ignore - columns set to 1
+#   - scaler - (mean, std) lists, or None if the data wasn't normalized
+#   - missing - the string marking a missing value
+########################################################################################
+class RowTransform:
+    def __init__(self, source_columns, target_index, dtype, encoders, discretizers, ignore, scaler, missing):
+        self.source_columns = source_columns
+        self.target_index = target_index
+        self.dtype = dtype
+        self.encoders = encoders
+        self.discretizers = {int(col): val for col, val in discretizers.items()}
+        self.ignore = ignore
+        self.scaler = scaler
+        self.missing = missing
+
+        self.encoder_objects = [None if encoder is None else CategoricalEncoder(encoder[0], unknown=encoder[1])
+                                for encoder in encoders]
+        self.discretizer_objects = {}
+        for col, (num_bins, strategy, edges) in self.discretizers.items():
+            self.discretizer_objects[col] = Discretizer(num_bins, strategy)
+            self.discretizer_objects[col].edges = numpy.array(edges)
+        self.scaler_object = None
+        if scaler is not None:
+            self.scaler_object = Scaler()
+            self.scaler_object.mean = numpy.array(scaler[0])
+            self.scaler_object.std = numpy.array(scaler[1])
+
+    def transform(self, rows):
+        """
+        Prepares a list of rows of strings. The rows can either have every column of the
+        original file, or every column but the target, but they must all be the same width.
+        :param rows:
+        :return: the attributes, and the targets or None when the rows have no target column
+        """
+        num_columns = len(self.source_columns)
+        if not len(rows):
+            return numpy.empty((0, self.target_index), dtype=self.dtype), None
+        widths = set(len(row) for row in rows)
+        if len(widths) > 1:
+            raise ValueError("Rows have different numbers of columns: " + str(sorted(widths)))
+        width = widths.pop()
+        if width != num_columns and width != num_columns - 1:
+            raise ValueError("Rows have " + str(width) + " columns, expected " + str(num_columns) + " or " +
+                             str(num_columns - 1) + " without the target")
+
+        columns = [numpy.array(column) for column in zip(*rows)]
+        has_target = width == num_columns
+        if not has_target:
+            # put a placeholder where the target column would be in the file
+            columns.insert(self.source_columns[self.target_index], numpy.full(len(rows), self.missing))
+
+        data = numpy.empty((len(rows), num_columns), dtype=self.dtype)
+        for idx, source in enumerate(self.source_columns):
+            values = columns[source]
+            values[values == self.missing] = "0"
+            if idx == self.target_index and not has_target:
+                data[:, idx] = 0
+            elif self.encoder_objects[idx] is not None:
+                data[:, idx] = self.encoder_objects[idx].transform(values)
+            else:
+                data[:, idx] = values.astype(data.dtype)
+
+        for col, discretizer in self.discretizer_objects.items():
+            data[:, col] = discretizer.transform(data[:, col])
+        for col in self.ignore:
+            data[:, col] = 1
+        if self.scaler_object is not None:
+            self.scaler_object.transform(data, in_place=True)
+
+        targets = data[:, self.target_index:self.target_index + 1] if has_target else None
+        return data[:, :self.target_index], targets
+
+    def transform_groups(self, rows):
+        """
+        Prepares rows which may mix rows with and without the target column, transforming the
+        rows of each width separately
+        :param rows:
+        :return: list of (positions of the rows in rows, attributes, targets or None) for each width
+        """
+        positions = {}
+        for idx, row in enumerate(rows):
+            positions.setdefault(len(row), []).append(idx)
+        groups = []
+        for width, group in sorted(positions.items()):
+            attributes, targets = self.transform([rows[idx] for idx in group])
+            groups.append((group, attributes, targets))
+        return groups
+
+    def decode_targets(self, targets):
+        """
+        Returns the original strings of encoded target values, or the values themselves if the
+        target column wasn't encoded
+        :param targets:
+        :return:
+        """
+        encoder = self.encoder_objects[self.target_index]
+        if encoder is None:
+            return list(targets)
+        return encoder.inverse_transform(numpy.asarray(targets, dtype=numpy.intp)).tolist()
+
+    def get_state(self):
+        return dict(source_columns=self.source_columns, target_index=self.target_index, dtype=self.dtype,
+                    encoders=self.encoders, discretizers=self.discretizers, ignore=self.ignore, scaler=self.scaler,
+                    missing=self.missing)
+
+
+########################################################################################
+# Discretizer class
+# Puts the values of a numeric column into bins numbered 0 to num_bins - 1. The bin edges
+# are fitted once and can then be applied to any data, e.g. the test set or streamed rows.
+#
+# Parameters:
+#   - num_bins - number of bins
+#   - strategy - "uniform" for bins of equal width between the smallest and largest
+#                values, "quantile" for bins holding an equal number of values
+#
+# Members:
+#   - edges - the inner bin edges. A value goes in the first bin whose edge it doesn't
+#             exceed, or the last bin if it exceeds them all.
+########################################################################################
+class Discretizer:
+    def __init__(self, num_bins=3, strategy="uniform"):
+        if strategy not in ("uniform", "quantile"):
+            raise ValueError("Unknown binning strategy " + str(strategy))
+        self.num_bins = num_bins
+        self.strategy = strategy
+        self.edges = None
+
+    def fit(self, values):
+        """
+        Finds the bin edges for values
+        :param values:
+        :return:
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if self.strategy == "quantile":
+            self.edges = numpy.quantile(values, numpy.linspace(0, 1, self.num_bins + 1)[1:-1])
+        else:
+            self.edges = numpy.linspace(values.min(), values.max(), self.num_bins + 1)[1:-1]
+        return self
+
+    def transform(self, values):
+        """
+        Returns the bin number of each value as the smallest integer type that holds them
+        :param values:
+        :return:
+        """
+        return numpy.searchsorted(self.edges, values, side="left").astype(numpy.min_scalar_type(self.num_bins - 1))
+
+    def fit_transform(self, values):
+        return self.fit(values).transform(values)
+
+
+########################################################################################
+# Scaler class
+# Turns each column into z scores using the mean and standard deviation it was fitted on,
+# so new data can be scaled the same way as the training data.
+#
+# Parameters:
+#   - skip - array of boolean values, True for columns which are left as they are
+#
+# Members:
+#   - mean - mean of each column, 0 for skipped columns and columns which don't vary
+#   - std - standard deviation of each column, 1 for skipped columns and columns which
+#           don't vary
+########################################################################################
+class Scaler:
+    def __init__(self, skip=None):
+        self.skip = skip
+        self.mean = None
+        self.std = None
+
+    def fit(self, data):
+        """
+        Finds the mean and standard deviation of every column of data
+        :param data:
+        :return:
+        """
+        data = numpy.asarray(data)
+        self.mean = data.mean(axis=0, dtype=numpy.float64)
+        self.std = data.std(axis=0, dtype=numpy.float64)
+        keep = self.std == 0
+        if self.skip is not None:
+            keep |= numpy.asarray(self.skip, dtype=bool)
+        self.mean[keep] = 0
+        self.std[keep] = 1
+        return self
+
+    def transform(self, data, in_place=False):
+        """
+        Returns the z scores of data, in the same dtype as data
+        :param data:
+        :param in_place: overwrite data with its z scores instead of making a new array
+        :return:
+        """
+        if not in_place:
+            data = numpy.array(data)
+        data -= self.mean
+        data /= self.std
+        return data
+
+    def fit_transform(self, data, in_place=False):
+        return self.fit(data).transform(data, in_place)
+
+
+########################################################################################
+# CategoricalEncoder class
+# Turns the string values of a column into integer codes, a whole array at a time.
+#
+# Parameters:
+#   - categories - fixed list of the values in the order of their codes. When not given the
+#                  categories are learned with fit or partial_fit.
+#   - unknown - what transform does with a value that isn't one of the categories
+#       * "error" - raise a ValueError
+#       * "extend" - add it as a new category with the next free code
+#       * an integer - use it as the code, e.g. -1
+#
+# Members:
+#   - categories - array of the values, the code of each value is its position
+#   - sorted_categories, sorter - the categories in sorted order, and their codes
+#   - dtype - smallest integer type which holds every code transform can return
+########################################################################################
+class CategoricalEncoder:
+    def __init__(self, categories=None, unknown="error"):
+        self.unknown = unknown
+        self.set_categories(numpy.array([], dtype=str))
+        if categories is not None:
+            self.partial_fit(numpy.array(categories, dtype=str))
+
+    @property
+    def dtype(self):
+        largest = max(len(self.categories) - 1, 0)
+        if isinstance(self.unknown, str):
+            return numpy.min_scalar_type(largest)
+        if self.unknown < 0:
+            return numpy.promote_types(numpy.min_scalar_type(-max(largest, 1)), numpy.min_scalar_type(self.unknown))
+        return numpy.min_scalar_type(max(largest, self.unknown))
+
+    def fit(self, values):
+        """
+        Learns the categories of values, forgetting any learned before. Codes are given in the
+        order the values are first seen.
+        :param values:
+        :return:
+        """
+        self.set_categories(numpy.array([], dtype=str))
+        return self.partial_fit(values)
+
+    def partial_fit(self, values):
+        """
+        Adds any values which aren't categories yet, giving them the next free codes in the
+        order they are first seen
+        :param values:
+        :return:
+        """
+        unique_values, first_seen = numpy.unique(numpy.asarray(values, dtype=str), return_index=True)
+        new = ~self.find(unique_values)[1]
+        if new.any():
+            order = numpy.argsort(first_seen[new], kind="stable")
+            self.set_categories(numpy.concatenate([self.categories, unique_values[new][order]]))
+        return self
+
+    def transform(self, values):
+        """
+        Returns the codes of values as an array of the encoder's dtype
+        :param values:
+        :return:
+        """
+        values = numpy.asarray(values, dtype=str)
+        if self.unknown == "extend":
+            self.partial_fit(values)
+        codes, found = self.find(values)
+        if not found.all():
+            if self.unknown == "error" or self.unknown == "extend":
+                raise ValueError("Value " + str(values[~found][0]) + " isn't one of the categories")
+            codes[~found] = self.unknown
+        return codes.astype(self.dtype)
+
+    def fit_transform(self, values):
+        return self.fit(values).transform(values)
+
+    def inverse_transform(self, codes):
+        return self.categories[numpy.asarray(codes, dtype=numpy.intp)]
+
+    def sort(self):
+        """
+        Renumbers the categories so their codes follow the sorted order of the values
+        :return: array giving the new code for each old code
+        """
+        new_codes = numpy.empty(len(self.categories), dtype=numpy.intp)
+        new_codes[self.sorter] = numpy.arange(len(self.categories))
+        self.set_categories(self.sorted_categories)
+        return new_codes
 
-        bins = numpy.linspace(d_min, d_max, num_bins)
-        for row_idx, row in enumerate(data):
-            bin_idx = 0
-            while row[col] > bins[bin_idx] and bin_idx < num_bins:
-                bin_idx += 1
-            row[col] = bin_idx
+    def set_categories(self, categories):
+        self.categories = categories
+        self.sorter = numpy.argsort(categories, kind="stable")
+        self.sorted_categories = categories[self.sorter]
 
+    def mapping(self):
+        return {val: i for i, val in enumerate(self.categories.tolist())}
 
+    def find(self, values):
+        """
+        Looks up values with a binary search of the sorted categories
+        :param values:
+        :return: the code of each value (meaningless where not found) and whether it was found
+        """
+        if not len(self.categories):
+            return numpy.zeros(len(values), dtype=numpy.intp), numpy.zeros(len(values), dtype=bool)
+        positions = numpy.searchsorted(self.sorted_categories, values)
+        numpy.minimum(positions, len(self.categories) - 1, out=positions)
+        return self.sorter[positions], self.sorted_categories[positions] == values
@@ -0,0 +1,159 @@
+import cProfile
+import json
+import time
+
+
+########################################################################################
+# profiler
+# Named timers and counters placed around the stages and inner loops of the data
+# loading and the classifiers. Nothing is recorded until enable() is called; while
+# disabled timer() hands back one shared object that does nothing and count() returns
+# straight away, so the instrumentation can stay in the hot paths.
+#
+# Names are dotted by stage, e.g. "dataset.parse" or "knn.distances". Only the
+# process that called enable() is measured, so work done in a multiprocessing pool is
+# counted in the time of the call that waits for it but not broken down further.
+#
+# Usage:
+#   with profiler.timer("id3.build"):
+#       ...
+#   profiler.count("id3.nodes")
+########################################################################################
+enabled = False
+timers = {}     # name -> [total seconds, number of calls]
+counters = {}   # name -> total
+started = None
+
+
+class Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        totals = timers.get(self.name)
+        if totals is None:
+            timers[self.name] = [elapsed, 1]
+        else:
+            totals[0] += elapsed
+            totals[1] += 1
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+NULL_TIMER = NullTimer()
+
+
+def enable():
+    global enabled, started
+    reset()
+    enabled = True
+    started = time.perf_counter()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    timers.clear()
+    counters.clear()
+
+
+def timer(name):
+    if not enabled:
+        return NULL_TIMER
+    return Timer(name)
+
+
+def count(name, amount=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def snapshot():
+    """
+    Returns everything recorded so far in a form which can be written as json
+    :return:
+    """
+    wall = time.perf_counter() - started if started is not None else 0.0
+    return {
+        "wall_s": wall,
+        "timers": {name: {"total_s": total, "calls": calls} for name, (total, calls) in sorted(timers.items())},
+        "counters": dict(sorted(counters.items())),
+    }
+
+
+def report(out=None):
+    """
+    Prints the time spent in each stage, sorted by name so nested stages follow their parents,
+    followed by the counters
+    :param out: file to print to, stdout by default
+    :return:
+    """
+    stats = snapshot()
+    wall = stats["wall_s"]
+    print("stage".ljust(36), "calls".rjust(9), "total (s)".rjust(11), "mean (ms)".rjust(11), "% wall".rjust(8),
+          file=out)
+    for name, totals in stats["timers"].items():
+        print(name.ljust(36), str(totals["calls"]).rjust(9), ("%.4f" % totals["total_s"]).rjust(11),
+              ("%.4f" % (totals["total_s"] / totals["calls"] * 1000)).rjust(11),
+              ("%.1f" % (totals["total_s"] / wall * 100 if wall > 0 else 0)).rjust(8), file=out)
+    if stats["counters"]:
+        print("counter".ljust(36), "total".rjust(9), file=out)
+        for name, total in stats["counters"].items():
+            print(name.ljust(36), str(total).rjust(9), file=out)
+    print("wall time (s)".ljust(36), ("%.4f" % wall).rjust(9), file=out)
+
+
+def dump(file_path):
+    """
+    Writes the timers and counters to file_path as json
+    :param file_path:
+    :return:
+    """
+    with open(file_path, "wt") as out:
+        json.dump(snapshot(), out, indent=1)
+
+
+def run(function, output=None):
+    """
+    Calls function with the timers and counters enabled, then prints the stage breakdown. When
+    output ends in .prof the call is also run under cProfile and the stats are written there for
+    pstats or snakeviz, otherwise when output is given the timers and counters are written to it
+    as json.
+    :param function:
+    :param output:
+    :return: what function returned
+    """
+    enable()
+    profile = cProfile.Profile() if output is not None and output.endswith(".prof") else None
+    try:
+        if profile is not None:
+            result = profile.runcall(function)
+        else:
+            result = function()
+    finally:
+        disable()
+        report()
+        if profile is not None:
+            profile.dump_stats(output)
+        elif output is not None:
+            dump(output)
+    return result
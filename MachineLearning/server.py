@@ -0,0 +1,276 @@
+import sys
+import getopt
+import asyncio
+import collections
+import concurrent.futures
+import csv
+import json
+import time
+import numpy
+import persistence
+
+
+########################################################################################
+# Prediction server
+# Serves predictions from a model saved with wrapper.py --save-model over HTTP, on a
+# TCP port or a Unix socket. The model is loaded once when the server starts.
+#
+#   POST /predict - the body is one or more csv rows, with or without the target column.
+#                   The response has the predicted target of each row, one per line.
+#   GET /metrics  - json with the request and batch counts, the p50/p99 latency of recent
+#                   requests and the depth of the queue of rows waiting to be predicted.
+#
+# Rows from concurrent requests are put on one queue. A single batcher task takes the
+# first row waiting, keeps taking rows until max_batch rows are collected or
+# batch_window seconds have passed, and predicts them all with one call to the
+# vectorized predict. A longer window gives bigger batches and more throughput at the
+# cost of latency; loadgen.py measures the tradeoff.
+########################################################################################
+class Metrics:
+    def __init__(self, window=10000):
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.latencies = collections.deque(maxlen=window)     # seconds, most recent requests only
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.queue_depths = collections.deque(maxlen=window)  # rows waiting when each batch started
+
+    def snapshot(self, queue_depth):
+        """
+        Returns the metrics in a form which can be written as json
+        :param queue_depth: the number of rows waiting right now
+        :return:
+        """
+        latencies = numpy.array(self.latencies) * 1000
+        p50, p99 = numpy.percentile(latencies, [50, 99]).tolist() if len(latencies) else (0.0, 0.0)
+        return {
+            "requests": self.requests,
+            "rows": self.rows,
+            "batches": self.batches,
+            "mean_batch_size": float(numpy.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            "latency_p50_ms": p50,
+            "latency_p99_ms": p99,
+            "queue_depth": queue_depth,
+            "mean_queue_depth": float(numpy.mean(self.queue_depths)) if self.queue_depths else 0.0,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class PredictionServer:
+    def __init__(self, net, transform, batch_window=.002, max_batch=256):
+        self.net = net
+        self.transform = transform
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.metrics = Metrics()
+        self.queue = None
+        # predict off the event loop so requests keep arriving while a batch runs. One thread,
+        # since the classifiers reuse their buffers between calls.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def predict(self, rows):
+        """
+        Queues rows to be predicted in the next batch and waits for their predictions
+        :param rows: list of rows of strings
+        :return: list of predicted target values
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for row in rows:
+            future = loop.create_future()
+            self.queue.put_nowait((row, future))
+            futures.append(future)
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.queue.qsize())
+        return await asyncio.gather(*futures)
+
+    async def run_batches(self):
+        """
+        Collects queued rows into batches and predicts them, forever
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            self.metrics.queue_depths.append(self.queue.qsize() + 1)
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                if self.queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+
+            rows = [row for row, future in batch]
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.predict_rows, rows)
+                for (row, future), prediction in zip(batch, predictions):
+                    if not future.done():
+                        future.set_result(prediction)
+            except Exception:
+                # one bad row fails the whole batch, so retry the rows one at a time to fail only it
+                for row, future in batch:
+                    try:
+                        prediction = (await loop.run_in_executor(self.executor, self.predict_rows, [row]))[0]
+                        if not future.done():
+                            future.set_result(prediction)
+                    except Exception as error:
+                        if not future.done():
+                            future.set_exception(error)
+            self.metrics.batches += 1
+            self.metrics.batch_sizes.append(len(batch))
+
+    def predict_rows(self, rows):
+        """
+        Predicts a batch of rows, which can mix rows with and without the target column since
+        they come from different requests
+        :param rows:
+        :return: list of predicted target values in the order of rows
+        """
+        predictions = [None] * len(rows)
+        for positions, attributes, targets in self.transform.transform_groups(rows):
+            for position, value in zip(positions, self.transform.decode_targets(self.net.predict(attributes))):
+                predictions[position] = value
+        return predictions
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answers HTTP/1.1 requests on one connection until the client closes it
+        :param reader:
+        :param writer:
+        :return:
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                start = time.perf_counter()
+                method, path = request_line.decode("latin-1").split()[:2]
+
+                # read the headers, keeping the ones needed
+                length = 0
+                keep_alive = True
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    name = name.strip().lower()
+                    if name == "content-length":
+                        length = int(value)
+                    elif name == "connection":
+                        keep_alive = value.strip().lower() != "close"
+                body = await reader.readexactly(length) if length else b""
+
+                if method == "POST" and path == "/predict":
+                    status, response = await self.handle_predict(body)
+                    if status == 200:
+                        self.metrics.latencies.append(time.perf_counter() - start)
+                elif method == "GET" and path == "/metrics":
+                    status, response = 200, json.dumps(self.metrics.snapshot(self.queue.qsize()), indent=1) + "\n"
+                else:
+                    status, response = 404, "Not found\n"
+
+                payload = response.encode()
+                writer.write(("HTTP/1.1 " + str(status) + " " + REASONS[status] + "\r\n" +
+                              "Content-Type: text/plain\r\nContent-Length: " + str(len(payload)) + "\r\n" +
+                              ("" if keep_alive else "Connection: close\r\n") + "\r\n").encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_predict(self, body):
+        rows = [row for row in csv.reader(body.decode().splitlines()) if row]
+        if not rows:
+            return 400, "No rows given\n"
+        self.metrics.requests += 1
+        self.metrics.rows += len(rows)
+        try:
+            predictions = await self.predict(rows)
+        except Exception as error:
+            return 400, str(error) + "\n"
+        return 200, "".join(str(value) + "\n" for value in predictions)
+
+    async def serve(self, host="127.0.0.1", port=8450, unix_path=None):
+        """
+        Starts the batcher and listens until cancelled
+        :param host:
+        :param port:
+        :param unix_path: listen on this Unix socket instead of host and port
+        :return:
+        """
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.run_batches())
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+            print("Serving on", unix_path, flush=True)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print("Serving on", host + ":" + str(port), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False)
+
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+
+
+def main(argv):
+    usage = "\tusage: --load-model=[directory] --host=[address] --port=[port] --unix=[socket_path] \
+            --batch-window=[ms] --max-batch=[rows]"
+
+    opts, args = getopt.getopt(argv[1:], "h", ["help", "load-model=", "host=", "port=", "unix=", "batch-window=",
+                                               "max-batch="])
+    model = None
+    host = "127.0.0.1"
+    port = 8450
+    unix_path = None
+    batch_window = 2.0
+    max_batch = 256
+
+    for key, val in opts:
+        if key in ("-h", "--help"):
+            print(usage)
+            sys.exit()
+        elif key == "--load-model":
+            model = val
+        elif key == "--host":
+            host = val
+        elif key == "--port":
+            port = int(val)
+        elif key == "--unix":
+            unix_path = val
+        elif key == "--batch-window":
+            batch_window = float(val)
+        elif key == "--max-batch":
+            max_batch = int(val)
+        else:
+            assert False, "unhandled option"
+
+    if model is None:
+        print("No model specified")
+        sys.exit(1)
+
+    # predict in this process only; a pool per batch would cost more than the batch itself
+    net, transform = persistence.load_model(model, n_jobs=1)
+    server = PredictionServer(net, transform, batch_window / 1000, max_batch)
+    try:
+        asyncio.run(server.serve(host, port, unix_path))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,88 @@
+import os
+import tracemalloc
+import numpy
+import pytest
+import classifier
+import preprocessor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def separable_rows(target_values, rows_per_target=20, seed=0):
+    rng = numpy.random.default_rng(seed)
+    attributes = numpy.vstack([rng.normal(idx * 4, .5, size=(rows_per_target, 2))
+                               for idx in range(len(target_values))])
+    targets = numpy.repeat(target_values, rows_per_target).astype(float).reshape(-1, 1)
+    return attributes, targets
+
+
+def test_perceptron_one_based_targets():
+    attributes, targets = separable_rows([1, 2, 3])
+    net = classifier.Perceptron(.1, [4], max_epochs=100, seed=1)
+    net.train(attributes, targets)
+    predictions = net.predict(attributes)
+    assert set(predictions) <= {1.0, 2.0, 3.0}
+    assert numpy.mean(numpy.array(predictions) == targets.ravel()) > .9
+
+
+def test_perceptron_targets_with_a_missing_class():
+    # a training fold which happens to hold no rows of target 1
+    attributes, targets = separable_rows([0, 2])
+    net = classifier.Perceptron(.1, [], max_epochs=50, seed=1)
+    net.train(attributes, targets)
+    assert net.num_targets == 2
+    assert set(net.predict(attributes)) <= {0.0, 2.0}
+
+
+def test_kdtree_matches_brute_force():
+    rng = numpy.random.default_rng(2)
+    # a numeric and a mapped column, with repeated values so there are ties to break
+    attributes = numpy.column_stack((rng.integers(0, 20, 3000) / 4, rng.integers(0, 5, 3000)))
+    targets = rng.integers(0, 3, (3000, 1)).astype(float)
+    tests = numpy.column_stack((rng.integers(0, 20, 500) / 4, rng.integers(0, 5, 500)))
+    for k in (1, 7):
+        brute = classifier.KNearestNeighbor(k=k)
+        brute.train(attributes, targets, [False, True])
+        indexed = classifier.KNearestNeighbor(k=k, index="kdtree", leaf_size=16, chunk_size=64)
+        indexed.train(attributes, targets, [False, True])
+        brute_nearest, brute_distances = brute.kneighbors(tests)
+        indexed_nearest, indexed_distances = indexed.kneighbors(tests)
+        assert numpy.array_equal(brute_nearest, indexed_nearest)
+        assert numpy.array_equal(brute_distances, indexed_distances)
+
+
+def test_perceptron_stops_after_patience_epochs_without_improvement():
+    attributes, targets = separable_rows([0, 1])
+    epochs = []
+    # with a learning rate of 0 the weights never change, so the first epoch is the best one
+    net = classifier.Perceptron(0, [], max_epochs=50, patience=5, seed=1,
+                                callback=lambda epoch, metrics: epochs.append(epoch))
+    net.train(attributes, targets)
+    assert epochs == [0, 1, 2, 3, 4, 5]
+    assert net.epochs_trained == 6
+
+
+@pytest.mark.parametrize("scale", [1, 10])
+@pytest.mark.parametrize("batch_size", [1, 16])
+def test_perceptron_training_does_not_allocate_after_warm_up(batch_size, scale):
+    # the same check as benchmark.py --bench=perceptron_alloc: nothing is allocated from the end
+    # of epoch 2 to the end of epoch 7, however many rows there are
+    data = preprocessor.DataSet(os.path.join(HERE, "diabetes.csv"), mapped=[8], norm=True, seed=0)
+    attributes = numpy.vstack([data.train_attributes] * scale)
+    targets = numpy.vstack([data.train_targets] * scale)
+    traced = {}
+
+    def trace_epoch(epoch, metrics):
+        if epoch == 2:
+            tracemalloc.start()
+            traced["start"] = tracemalloc.get_traced_memory()[0]
+        elif epoch == 7:
+            traced["peak"] = tracemalloc.get_traced_memory()[1] - traced["start"]
+            tracemalloc.stop()
+
+    net = classifier.Perceptron(.1, [4, 4], batch_size=batch_size, max_epochs=8, validation=20, callback=trace_epoch)
+    try:
+        net.train(attributes, targets)
+    finally:
+        tracemalloc.stop()
+    assert traced["peak"] < 16 * 1024
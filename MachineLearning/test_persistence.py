@@ -0,0 +1,39 @@
+import os
+import pytest
+import classifier
+import persistence
+import preprocessor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def trained_model():
+    data = preprocessor.DataSet(os.path.join(HERE, "iris.csv"), mapped=[4], bins={0: 3, 1: 3, 2: 3, 3: 3}, seed=1)
+    net = classifier.ID3()
+    net.train(data.train_attributes, data.train_targets)
+    return net, data.row_transform()
+
+
+def test_save_model_replaces_only_models(tmp_path):
+    net, transform = trained_model()
+    model_path = tmp_path / "model"
+    persistence.save_model(str(model_path), net, transform)
+    persistence.save_model(str(model_path), net, transform)
+    assert persistence.is_model_directory(str(model_path))
+
+    empty = tmp_path / "empty"
+    empty.mkdir()
+    persistence.save_model(str(empty), net, transform)
+    assert persistence.is_model_directory(str(empty))
+
+
+def test_save_model_refuses_other_directories(tmp_path):
+    net, transform = trained_model()
+    victim = tmp_path / "victim"
+    (victim / "sub").mkdir(parents=True)
+    (victim / "notes.txt").write_text("keep me")
+    with pytest.raises(ValueError):
+        persistence.save_model(str(victim), net, transform)
+    assert (victim / "notes.txt").read_text() == "keep me"
+    assert (victim / "sub").is_dir()
+    assert not [name for name in os.listdir(str(tmp_path)) if name.startswith(".model-")]
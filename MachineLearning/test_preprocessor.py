@@ -0,0 +1,53 @@
+import csv
+import os
+import numpy
+import pytest
+import preprocessor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def voting_transform():
+    data = preprocessor.DataSet(os.path.join(HERE, "voting.csv"), target=0, mapped=list(range(17)), seed=1)
+    with open(os.path.join(HERE, "voting.csv"), "rt") as csv_file:
+        rows = [row for row in csv.reader(csv_file) if row]
+    return data.row_transform(), rows
+
+
+def test_row_transform_rejects_mixed_widths():
+    transform, rows = voting_transform()
+    full = rows[:3]
+    no_target = [row[1:] for row in rows[3:6]]
+    with pytest.raises(ValueError):
+        transform.transform(full + no_target)
+    with pytest.raises(ValueError):
+        transform.transform([row[2:] for row in rows[:3]])
+
+
+def test_row_transform_groups_match_separate_transforms():
+    transform, rows = voting_transform()
+    full = rows[:3]
+    no_target = [row[1:] for row in rows[3:6]]
+    mixed = [full[0], no_target[0], full[1], no_target[1], full[2], no_target[2]]
+
+    groups = transform.transform_groups(mixed)
+    assert len(groups) == 2
+    attributes = numpy.empty((len(mixed), transform.target_index))
+    for positions, group_attributes, targets in groups:
+        attributes[positions] = group_attributes
+
+    expected_full = transform.transform(full)[0]
+    expected_no_target = transform.transform(no_target)[0]
+    assert numpy.array_equal(attributes[0::2], expected_full)
+    assert numpy.array_equal(attributes[1::2], expected_no_target)
+    # the target column is the only difference between the two layouts
+    assert numpy.array_equal(transform.transform([row[1:] for row in full])[0], expected_full)
+
+
+def test_cached_data_set_matches_parsed(tmp_path):
+    path = os.path.join(HERE, "car.csv")
+    options = dict(mapped=list(range(7)), seed=3, cache_dir=str(tmp_path))
+    parsed = preprocessor.DataSet(path, **options)
+    cached = preprocessor.DataSet(path, **options)
+    assert not isinstance(cached.data_array, numpy.memmap)
+    assert numpy.array_equal(parsed.data_array, cached.data_array)
@@ -0,0 +1,35 @@
+import asyncio
+import csv
+import os
+import classifier
+import preprocessor
+from server import PredictionServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_mixed_width_batch_matches_single_predictions():
+    data = preprocessor.DataSet(os.path.join(HERE, "voting.csv"), target=0, mapped=list(range(17)), seed=1)
+    net = classifier.ID3()
+    net.train(data.train_attributes, data.train_targets)
+    with open(os.path.join(HERE, "voting.csv"), "rt") as csv_file:
+        rows = [row for row in csv.reader(csv_file) if row][:40]
+    # every other request leaves out the target column, which is the first column of voting.csv
+    requests = [[row] if idx % 2 else [row[1:]] for idx, row in enumerate(rows)]
+
+    server = PredictionServer(net, data.row_transform(), batch_window=1, max_batch=len(requests))
+    expected = [server.predict_rows(request) for request in requests]
+    assert server.predict_rows([request[0] for request in requests]) == [values[0] for values in expected]
+
+    async def send_all():
+        server.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(server.run_batches())
+        try:
+            return await asyncio.gather(*[server.predict(request) for request in requests])
+        finally:
+            batcher.cancel()
+
+    results = asyncio.run(send_all())
+    server.executor.shutdown()
+    assert server.metrics.batches == 1
+    assert results == expected
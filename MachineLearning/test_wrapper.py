@@ -0,0 +1,28 @@
+import os
+import classifier
+import preprocessor
+import wrapper
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ORDERED = {0: ["low", "med", "high", "vhigh"], 1: ["low", "med", "high", "vhigh"], 2: ["2", "3", "4", "5more"],
+           3: ["2", "4", "more"], 4: ["small", "med", "big"], 5: ["low", "med", "high"]}
+
+
+def test_stream_predictions_skips_bad_rows(tmp_path):
+    data = preprocessor.DataSet(os.path.join(HERE, "car.csv"), ordered=ORDERED, mapped=[6], seed=1)
+    net = classifier.ID3()
+    net.train(data.train_attributes, data.train_targets)
+    transform = data.row_transform()
+
+    good = [["vhigh", "vhigh", "2", "2", "small", "low"], ["low", "low", "4", "4", "big", "high", "vgood"],
+            ["med", "med", "3", "4", "med", "med"]]
+    expected = wrapper.predict_rows(net, transform, good)
+    input_path = tmp_path / "rows.csv"
+    output_path = tmp_path / "predictions.txt"
+    # an unknown value in an ordered column, then a row with too few columns, in separate chunks
+    input_path.write_text("\n".join([",".join(good[0]), "bogus,vhigh,2,2,small,low", ",".join(good[1]),
+                                     "low,low", ",".join(good[2])]) + "\n")
+
+    num_rows = wrapper.stream_predictions(net, transform, str(input_path), str(output_path), 2)
+    assert num_rows == 3
+    assert output_path.read_text().split("\n") == [expected[0], "", expected[1], "", expected[2], ""]
@@ -1,19 +1,50 @@
 import sys
+import csv
 import getopt
+import itertools
+import json
+import time
+import multiprocessing
+import numpy
 import classifier
+import persistence
 import preprocessor
+import profiler
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn import tree
+from multiprocessing import shared_memory
 
 
-def main(argv):
+def parse_args(argv):
+    """
+    Reads the command line options
+    :param argv:
+    :return: map of option name to value, with the classifier settings under "settings"
+    """
     usage = "\tusage: --dataset=[file_name] --split=[1-100] --classifier=[algorithm_name] --target=[index] \
             --ordered=[column:val0|val1|val2,column2:val0|val1],etc --ignore=[col1,col2,etc] \
-            --mapped=[1,2,3,etc] --bins=[col:num_bins,col:num_bins] --normalize"
+            --mapped=[1,2,3,etc] --bins=[col:num_bins,col:num_bins] --bin-strategy=[uniform|quantile] --normalize \
+            --index=[kdtree|lsh] --jobs=[num_processes] \
+            --k=[neighbors] --lsh-tables=[num_tables] --lsh-hashes=[hashes_per_table] --trees=[num_trees] \
+            --batch-size=[rows_per_step] --epochs=[max_epochs] --validation=[0-100] --patience=[epochs] \
+            --verbose --seed=[int] --dtype=[float32|float64] --cache-dir=[directory] (cache the parsed data set) \
+            --folds=[num_folds] (use --classifier=all to cross validate every classifier) \
+            --learning-rate=[rate] --layers=[nodes-nodes-etc] --search=[grid|random] \
+            --params=[name:val1|val2,name:low~high,etc] --params-file=[json_file] --samples=[num_candidates] \
+            --prune=[accuracy_points] --profile --profile-output=[file.json|file.prof] \
+            --save-model=[directory] --load-model=[directory] (predicts every row of the data set) \
+            --predict=[file|-] (write predictions for every row of file, or stdin) --output=[file|-] \
+            --chunk-size=[rows]"
 
     # get args
     opts, args = getopt.getopt(argv[1:], "h", ["help", "dataset=", "split=", "classifier=", "target=", "ordered=",
-                                               "ignore=", "mapped=", "normalize", "bins="])
+                                               "ignore=", "mapped=", "normalize", "bins=", "bin-strategy=", "index=",
+                                               "jobs=", "k=", "lsh-tables=", "lsh-hashes=", "trees=", "batch-size=",
+                                               "epochs=", "validation=", "patience=", "verbose",
+                                               "seed=", "dtype=", "cache-dir=", "folds=", "learning-rate=", "layers=",
+                                               "search=", "params=", "params-file=", "samples=", "prune=",
+                                               "profile", "profile-output=", "save-model=", "load-model=",
+                                               "predict=", "output=", "chunk-size="])
     # handle args
     data_set = class_name = "none"
     split = 70
@@ -22,7 +53,36 @@ def main(argv):
     ignore = []
     mapped = []
     bins = {}
+    bin_strategy = "uniform"
     norm = False
+    index = None
+    jobs = None
+    k = None
+    lsh_tables = 8
+    lsh_hashes = 4
+    trees = 10
+    batch_size = 1
+    epochs = 300
+    validation = 0
+    patience = None
+    verbose = False
+    seed = None
+    dtype = "float64"
+    cache_dir = None
+    folds = 0
+    learning_rate = .1
+    layers = [4, 4]
+    search = None
+    params = {}
+    samples = 10
+    prune = None
+    profile = False
+    profile_output = None
+    save_model = None
+    load_model = None
+    predict = None
+    output = "-"
+    chunk_size = 10000
 
     for key, val in opts:
         if key in ("-h", "--help"):
@@ -54,84 +114,747 @@ def main(argv):
             for entry in entries:
                 entry_split = entry.split(":")
                 bins[int(entry_split[0])] = int(entry_split[1])
+        elif key == "--bin-strategy":
+            bin_strategy = val
         elif key == "--normalize":
             norm = True
+        elif key == "--index":
+            index = val
+        elif key == "--jobs":
+            jobs = int(val)
+        elif key == "--k":
+            k = int(val)
+        elif key == "--lsh-tables":
+            lsh_tables = int(val)
+        elif key == "--lsh-hashes":
+            lsh_hashes = int(val)
+        elif key == "--trees":
+            trees = int(val)
+        elif key == "--batch-size":
+            batch_size = int(val)
+        elif key == "--epochs":
+            epochs = int(val)
+        elif key == "--validation":
+            validation = int(val)
+        elif key == "--patience":
+            patience = int(val)
+        elif key == "--verbose":
+            verbose = True
+        elif key == "--seed":
+            seed = int(val)
+        elif key == "--dtype":
+            dtype = val
+        elif key == "--cache-dir":
+            cache_dir = val
+        elif key == "--folds":
+            folds = int(val)
+        elif key == "--learning-rate":
+            learning_rate = float(val)
+        elif key == "--layers":
+            layers = [int(nodes) for nodes in val.split("-") if nodes]
+        elif key == "--search":
+            search = val
+        elif key == "--params":
+            for entry in val.split(","):
+                entry_split = entry.split(":")
+                params[entry_split[0]] = parse_param_values(entry_split[0], entry_split[1])
+        elif key == "--params-file":
+            params.update(load_param_file(val))
+        elif key == "--samples":
+            samples = int(val)
+        elif key == "--prune":
+            prune = float(val)
+        elif key == "--profile":
+            profile = True
+        elif key == "--profile-output":
+            profile = True
+            profile_output = val
+        elif key == "--save-model":
+            save_model = val
+        elif key == "--load-model":
+            load_model = val
+        elif key == "--predict":
+            predict = val
+        elif key == "--output":
+            output = val
+        elif key == "--chunk-size":
+            chunk_size = int(val)
 
         else:
             assert False, "unhandled option"
 
+    settings = dict(k=k, index=index, jobs=jobs, lsh_tables=lsh_tables, lsh_hashes=lsh_hashes, trees=trees,
+                    batch_size=batch_size, epochs=epochs, validation=validation, patience=patience,
+                    verbose=verbose, dtype=dtype, seed=seed, learning_rate=learning_rate, layers=layers)
+
+    return dict(data_set=data_set, class_name=class_name, split=split, target=target, ordered=ordered,
+                ignore=ignore, mapped=mapped, bins=bins, bin_strategy=bin_strategy, norm=norm, cache_dir=cache_dir,
+                folds=folds, search=search, params=params, samples=samples, prune=prune, profile=profile,
+                profile_output=profile_output, save_model=save_model, load_model=load_model,
+                predict=predict, output=output, chunk_size=chunk_size, settings=settings)
+
+
+def main(argv):
+    options = parse_args(argv)
+
+    # print where the time went, and optionally write it to a json file or a cProfile dump
+    if options["profile"]:
+        profiler.run(lambda: run(options), options["profile_output"])
+    else:
+        run(options)
+
+
+def run(options):
+    settings = options["settings"]
+    class_name = options["class_name"]
+
     # Load the data set
     data = None
 
+    # score new rows with a saved model, no data set needed
+    if options["load_model"] and options["predict"]:
+        net, transform = persistence.load_model(options["load_model"], n_jobs=settings["jobs"])
+        stream_predictions(net, transform, options["predict"], options["output"], options["chunk_size"])
+        return
     # default load iris data
-    if data_set == "none":
+    elif options["data_set"] == "none":
         print("No data set specified")
         sys.exit()
+    # check a model can be saved before spending the time to train it
+    elif options["save_model"] and class_name not in SAVED_CLASSIFIERS:
+        print("Can't save a", class_name, "model, only", ", ".join(SAVED_CLASSIFIERS))
+        sys.exit(1)
+    # predict with a saved model instead of training one
+    elif options["load_model"]:
+        predict_saved_model(options)
+        return
+    # cross validate or search for settings. Binning and normalizing are fitted on each fold
+    # separately, so they're left out of the data set.
+    elif options["folds"] or options["search"]:
+        data = load_data_set(options, split=100, prepare=False)
+        class_names = CLASSIFIERS if class_name == "all" else [class_name]
+        if any(make_classifier(name, settings) is None for name in class_names):
+            print("Unrecognized classifier")
+            sys.exit(1)
+        if options["search"]:
+            hyperparameter_search(data, class_names, options["params"], options["search"], options["samples"],
+                                  options["folds"], options["split"], options["prune"], settings, options["bins"],
+                                  options["bin_strategy"], options["norm"])
+        else:
+            cross_validate(data, class_names, options["folds"], options["split"], settings, options["bins"],
+                           options["bin_strategy"], options["norm"])
+        return
     # load from a csv file
     else:
-        data = preprocessor.DataSet(data_set, ordered=ordered, target=target, split=split, ignore=ignore,
-                                    mapped=mapped, norm=norm, bins=bins)
+        if options["save_model"]:
+            try:
+                persistence.check_model_directory(options["save_model"])
+            except ValueError as error:
+                print(error)
+                sys.exit(1)
+        with profiler.timer("load"):
+            data = load_data_set(options)
 
     # select the network to use
-    net = None
-    predict_targets = None
+    settings["jobs"] = settings["jobs"] or 1
+    net = make_classifier(class_name, settings)
+    if net is None:
+        print("Unrecognized classifier")
+        sys.exit(1)
 
-    if class_name == "HardCoded":
-        net = classifier.HardCoded()
-        # train
-        net.train(data.train_attributes, data.train_targets, data.mapped_columns)
-        # predict
+    # train
+    with profiler.timer("train"):
+        train(net, data.train_attributes, data.train_targets, data.mapped_columns)
+    if class_name == "DecisionTree" and net.root is not None:
+        net.output_tree(net.root, 0)
+    if options["save_model"]:
+        persistence.save_model(options["save_model"], net, data.row_transform())
+
+    # predict
+    with profiler.timer("predict"):
         predictions = net.predict(data.test_attributes)
-        predict_targets = data.test_targets
+
+    # compare the approximate neighbors against an exact search
+    if class_name == "KNearestNeighbors" and settings["index"] == "lsh":
+        report_recall(net, data)
+
+    # test the predictions
+    print("The number of correct predictions is: ", str(accuracy(predictions, data.test_targets)), "%")
+
+    # score new rows with the model just trained
+    if options["predict"]:
+        stream_predictions(net, data.row_transform(), options["predict"], options["output"], options["chunk_size"])
+
+
+def stream_predictions(net, transform, input_path, output_path, chunk_size):
+    """
+    Predicts the rows of a csv file chunk_size rows at a time, writing the predicted target values
+    one per line as each chunk is done, so only one chunk is held in memory however long the input
+    is. The rows are prepared with transform and may leave out the target column, row by row. A
+    row which can't be prepared (the wrong number of columns, or a value the model doesn't know in
+    an ordered or numeric column) is reported to stderr with its line number and gets an empty
+    output line, so there is still one output line for every non-blank input line. The number of
+    rows, skipped rows and rows per second are printed to stderr at the end.
+    :param net:
+    :param transform: the RowTransform of the data the model was trained on
+    :param input_path: csv file to read, or "-" for stdin
+    :param output_path: file to write, or "-" for stdout
+    :param chunk_size:
+    :return: number of rows predicted
+    """
+    in_file = sys.stdin if input_path == "-" else open(input_path, "rt", newline="")
+    out_file = sys.stdout if output_path == "-" else open(output_path, "wt")
+    num_rows = 0
+    num_skipped = 0
+    start = time.perf_counter()
+    try:
+        reader = csv.reader(in_file)
+        while True:
+            rows = []
+            line_numbers = []
+            num_read = 0
+            with profiler.timer("stream.read"):
+                for row in itertools.islice(reader, chunk_size):
+                    num_read += 1
+                    if row:
+                        rows.append(row)
+                        line_numbers.append(reader.line_num)
+            if not num_read:
+                break
+
+            # predict the whole chunk, and only when that fails find the rows at fault, so the
+            # chunk is checked before any of it is written
+            try:
+                predictions = predict_rows(net, transform, rows)
+            except ValueError:
+                good = []
+                for idx, row in enumerate(rows):
+                    try:
+                        transform.transform([row])
+                        good.append(idx)
+                    except ValueError as error:
+                        print("Skipped line", line_numbers[idx], "-", error, file=sys.stderr)
+                predictions = [""] * len(rows)
+                for idx, value in zip(good, predict_rows(net, transform, [rows[idx] for idx in good])):
+                    predictions[idx] = value
+                num_skipped += len(rows) - len(good)
+                num_rows -= len(rows) - len(good)
+            num_rows += len(rows)
+
+            with profiler.timer("stream.write"):
+                out_file.writelines(str(value) + "\n" for value in predictions)
+                out_file.flush()
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+        if out_file is not sys.stdout:
+            out_file.close()
+
+    elapsed = time.perf_counter() - start
+    print("Predicted", num_rows, "rows in", "%.3f" % elapsed, "s,", "%.0f" % (num_rows / elapsed if elapsed > 0 else 0),
+          "rows/sec", file=sys.stderr)
+    if num_skipped:
+        print("Skipped", num_skipped, "rows which couldn't be read", file=sys.stderr)
+    return num_rows
+
+
+def predict_rows(net, transform, rows):
+    """
+    Predicts rows of strings, which may mix rows with and without the target column
+    :param net:
+    :param transform:
+    :param rows:
+    :return: the decoded predictions in the order of rows
+    """
+    predictions = [None] * len(rows)
+    with profiler.timer("stream.transform"):
+        groups = transform.transform_groups(rows)
+    for positions, attributes, targets in groups:
+        with profiler.timer("stream.predict"):
+            values = transform.decode_targets(net.predict(attributes))
+        for position, value in zip(positions, values):
+            predictions[position] = value
+    return predictions
+
+
+def predict_saved_model(options):
+    """
+    Loads the model given by --load-model and predicts every row of the data set with it. The rows
+    are prepared with the model's saved transform, so the data set options aren't needed.
+    :param options:
+    :return:
+    """
+    with profiler.timer("load"):
+        net, transform = persistence.load_model(options["load_model"], n_jobs=options["settings"]["jobs"])
+        with open(options["data_set"], "rt") as csv_file:
+            attributes, targets = transform.transform([row for row in csv.reader(csv_file) if row])
+
+    with profiler.timer("predict"):
+        predictions = net.predict(attributes)
+
+    if targets is None:
+        print("Predicted", len(predictions), "rows")
+    else:
+        print("The number of correct predictions is: ", str(accuracy(predictions, targets)), "%")
+
+
+def load_data_set(options, split=None, prepare=True):
+    """
+    Loads the data set given on the command line
+    :param options: the options from parse_args
+    :param split: overrides the split option
+    :param prepare: when False the data isn't binned or normalized
+    :return:
+    """
+    settings = options["settings"]
+    return preprocessor.DataSet(options["data_set"], ordered=options["ordered"], target=options["target"],
+                                split=options["split"] if split is None else split, ignore=options["ignore"],
+                                mapped=options["mapped"], norm=prepare and options["norm"],
+                                bins=options["bins"] if prepare else None, dtype=settings["dtype"],
+                                seed=settings["seed"], cache_dir=options["cache_dir"],
+                                bin_strategy=options["bin_strategy"], norm_in_place=True)
+
+
+def make_classifier(class_name, settings):
+    """
+    Creates an untrained classifier from its name and the command line settings
+    :param class_name:
+    :param settings:
+    :return: the classifier, or None if the name isn't recognized
+    """
+    if class_name == "HardCoded":
+        return classifier.HardCoded()
     elif class_name == "KNearestNeighbors":
-        net = classifier.KNearestNeighbor(k=1)
-        # train
-        net.train(data.train_attributes, data.train_targets, data.mapped_columns)
-        # predict
-        predictions = net.predict(data.test_attributes)
-        predict_targets = data.test_targets
+        return classifier.KNearestNeighbor(k=settings["k"] or 1, index=settings["index"], n_jobs=settings["jobs"],
+                                           lsh_tables=settings["lsh_tables"], lsh_hashes=settings["lsh_hashes"],
+                                           seed=settings["seed"])
     elif class_name == "KNearestNeighbors_alt":
-        net = KNeighborsClassifier(n_neighbors=5)
-        # train
-        net.fit(data.train_attributes, data.train_targets.ravel())
-        # predict
-        predictions = net.predict(data.test_attributes)
-        predict_targets = data.test_targets
+        return KNeighborsClassifier(n_neighbors=settings["k"] or 5)
     elif class_name == "DecisionTree":
-        net = classifier.ID3()
-        # train
-        net.train(data.train_attributes, data.train_targets)
-        net.output_tree(net.root, 0)
-        # predict
-        predictions = net.predict(data.test_attributes)
-        predict_targets = data.test_targets
+        return classifier.ID3(n_jobs=settings["jobs"])
+    elif class_name == "RandomForest":
+        return classifier.RandomForest(num_trees=settings["trees"], n_jobs=settings["jobs"], seed=settings["seed"])
     elif class_name == "DecisionTree_alt":
-        net = tree.DecisionTreeClassifier()
-        # train
-        net.fit(data.train_attributes, data.train_targets.ravel())
-        # predict
-        predictions = net.predict(data.test_attributes)
-        predict_targets = data.test_targets
+        return tree.DecisionTreeClassifier(random_state=settings["seed"])
     elif class_name == "Perceptron":
-        net = classifier.Perceptron(.1, [4, 4])
-        # train
-        net.train(data.train_attributes, data.train_targets)
-        # predict
-        predictions = net.predict(data.test_attributes)
-        predict_targets = data.test_targets
+        return classifier.Perceptron(settings["learning_rate"], settings["layers"], batch_size=settings["batch_size"],
+                                     max_epochs=settings["epochs"], validation=settings["validation"],
+                                     patience=settings["patience"],
+                                     callback=print_epoch if settings["verbose"] else None,
+                                     dtype=settings["dtype"], seed=settings["seed"])
+    return None
+
+
+def train(net, attributes, targets, mapped):
+    """
+    Trains either one of our classifiers or one of the sklearn baselines
+    :param net:
+    :param attributes:
+    :param targets:
+    :param mapped:
+    :return:
+    """
+    if isinstance(net, (KNeighborsClassifier, tree.DecisionTreeClassifier)):
+        net.fit(attributes, targets.ravel())
+    elif isinstance(net, (classifier.HardCoded, classifier.KNearestNeighbor)):
+        net.train(attributes, targets, mapped)
     else:
-        print("Unrecognized classifier")
-        sys.exit(1)
+        net.train(attributes, targets)
 
-    # test the predictions
-    i = 0
-    num_right = 0
-    while i < len(predictions):
-        if predictions[i] == predict_targets[i]:
-            num_right += 1
-        i += 1
-
-    print("The number of correct predictions is: ", str(num_right / len(predictions) * 100), "%")
+
+def accuracy(predictions, targets):
+    return numpy.mean(numpy.asarray(predictions, dtype=float).ravel() == targets.ravel()) * 100
+
+
+# classifiers run by --classifier=all
+CLASSIFIERS = ["HardCoded", "KNearestNeighbors", "KNearestNeighbors_alt", "DecisionTree", "RandomForest",
+               "DecisionTree_alt", "Perceptron"]
+
+# classifiers --save-model works for
+SAVED_CLASSIFIERS = ["KNearestNeighbors", "DecisionTree", "Perceptron"]
+
+# the settings each classifier uses, which are the ones searched for it. "bins" and "norm" change
+# the preparation of the data and are searched for every classifier.
+CLASSIFIER_SETTINGS = {
+    "HardCoded": [],
+    "KNearestNeighbors": ["k", "index", "lsh_tables", "lsh_hashes"],
+    "KNearestNeighbors_alt": ["k"],
+    "DecisionTree": [],
+    "RandomForest": ["trees"],
+    "DecisionTree_alt": [],
+    "Perceptron": ["learning_rate", "layers", "batch_size", "epochs", "validation", "patience"],
+}
+DATA_SETTINGS = ["bins", "norm"]
+
+
+# Fold workers read the data set out of shared memory rather than having it pickled to them.
+# Each worker attaches to the shared memory once, when the pool starts.
+worker_fold_data = None
+
+
+def init_fold_worker(memory_name, shape, dtype, info):
+    global worker_fold_data
+    memory = shared_memory.SharedMemory(name=memory_name)
+    worker_fold_data = dict(info, memory=memory, data=numpy.ndarray(shape, dtype=dtype, buffer=memory.buf))
+
+
+def run_fold(task):
+    """
+    Trains and tests one classifier on one fold of the shared data set for each of a list of
+    candidate settings. The candidates all prepare the data the same way. More than one candidate
+    is only given for KNearestNeighbors candidates which differ in k alone, which share one search
+    for the neighbors.
+    :param task: the classifier name, a list of (candidate number, settings), the fold number, and
+                 the first and last + 1 rows of the test fold
+    :return: list of (classifier name, candidate number, fold number, accuracy, train time,
+             predict time, wall time)
+    """
+    class_name, candidates, fold, start, end = task
+    start_time = time.perf_counter()
+    data = worker_fold_data["data"]
+    target_index = worker_fold_data["target_index"]
+    mapped = worker_fold_data["mapped"]
+    params = candidates[0][1]
+    settings = dict(worker_fold_data["settings"], **params)
+    bins = worker_fold_data["bins"]
+    if "bins" in params:
+        bins = {col: params["bins"] for col in bins}
+
+    # copy the fold out of the shared array since binning and normalizing change it
+    train_data = numpy.concatenate([data[:start], data[end:]])
+    test_data = numpy.array(data[start:end])
+    prepare_fold(train_data, test_data, bins, worker_fold_data["bin_strategy"],
+                 settings.get("norm", worker_fold_data["norm"]), mapped)
+    test_targets = test_data[:, target_index:target_index + 1]
+
+    train_start = time.perf_counter()
+    if len(candidates) > 1:
+        net = make_classifier(class_name, dict(settings, k=max(params["k"] for _, params in candidates)))
+    else:
+        net = make_classifier(class_name, settings)
+    train(net, train_data[:, :target_index], train_data[:, target_index:target_index + 1], mapped)
+    predict_start = time.perf_counter()
+    if len(candidates) > 1:
+        predictions = net.predict_each_k(test_data[:, :target_index], [params["k"] for _, params in candidates])
+        predictions = [predictions[params["k"]] for _, params in candidates]
+    else:
+        predictions = [net.predict(test_data[:, :target_index])]
+    end_time = time.perf_counter()
+
+    return [(class_name, candidate, fold, accuracy(candidate_predictions, test_targets), predict_start - train_start,
+             end_time - predict_start, end_time - start_time)
+            for (candidate, _), candidate_predictions in zip(candidates, predictions)]
+
+
+def prepare_fold(train_data, test_data, bins, bin_strategy, norm, mapped):
+    """
+    Bins and normalizes the rows of a fold in place, fitting on the training rows only
+    :param train_data:
+    :param test_data:
+    :param bins:
+    :param bin_strategy:
+    :param norm:
+    :param mapped:
+    :return:
+    """
+    for col, num_bins in bins.items():
+        discretizer = preprocessor.Discretizer(num_bins, bin_strategy).fit(train_data[:, col])
+        train_data[:, col] = discretizer.transform(train_data[:, col])
+        test_data[:, col] = discretizer.transform(test_data[:, col])
+
+    if norm:
+        scaler = preprocessor.Scaler(mapped).fit(train_data)
+        scaler.transform(train_data, in_place=True)
+        scaler.transform(test_data, in_place=True)
+
+
+def open_fold_workers(data, settings, bins, bin_strategy, norm):
+    """
+    Copies the data set into shared memory and starts the pool of fold workers. The classifiers
+    themselves run serially since pool workers can't start pools of their own.
+    :param data:
+    :param settings:
+    :param bins: map of column number in the file to number of bins
+    :param bin_strategy:
+    :param norm:
+    :return: the shared memory and the pool, which is None when running in this process
+    """
+    jobs = settings["jobs"]
+    processes = multiprocessing.cpu_count() if jobs is None or jobs == -1 else jobs
+    info = dict(target_index=data.target_index, mapped=data.mapped_columns,
+                settings=dict(settings, jobs=1, verbose=False),
+                bins={data.source_columns[col]: num_bins for col, num_bins in bins.items()},
+                bin_strategy=bin_strategy, norm=norm)
+
+    array = data.data_array
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    numpy.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[:] = array
+    init_args = (memory.name, array.shape, array.dtype, info)
+    if processes > 1:
+        return memory, multiprocessing.Pool(processes, initializer=init_fold_worker, initargs=init_args)
+    init_fold_worker(*init_args)
+    return memory, None
+
+
+def run_fold_tasks(pool, tasks):
+    if pool is None:
+        return [result for task in tasks for result in run_fold(task)]
+    return [result for results in pool.map(run_fold, tasks, chunksize=1) for result in results]
+
+
+def close_fold_workers(memory, pool):
+    global worker_fold_data
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        worker_fold_data["memory"].close()
+        worker_fold_data = None
+    memory.close()
+    memory.unlink()
+
+
+def fold_bounds(num_rows, folds, split):
+    """
+    Returns the first and last + 1 rows of the test rows of each fold. A single fold tests on
+    the rows after the split instead.
+    :param num_rows:
+    :param folds:
+    :param split:
+    :return:
+    """
+    if folds <= 1:
+        return [(num_rows * split // 100, num_rows)]
+    bounds = numpy.linspace(0, num_rows, folds + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def cross_validate(data, class_names, folds, split, settings, bins, bin_strategy, norm):
+    """
+    Splits the (already shuffled) rows of data into folds and trains and tests every classifier
+    on every fold in a process pool, then prints the mean and standard deviation of the accuracy
+    and the wall time of each fold
+    :param data:
+    :param class_names:
+    :param folds:
+    :param split: percent of the rows to train on when there's a single fold
+    :param settings:
+    :param bins: map of column number in the file to number of bins
+    :param bin_strategy:
+    :param norm:
+    :return: map of classifier name to list of (accuracy, wall time) for each fold
+    """
+    bounds = fold_bounds(len(data.data_array), folds, split)
+    tasks = [(class_name, [(0, {})], fold, start, end) for class_name in class_names
+             for fold, (start, end) in enumerate(bounds)]
+
+    memory, pool = open_fold_workers(data, settings, bins, bin_strategy, norm)
+    try:
+        results = run_fold_tasks(pool, tasks)
+    finally:
+        close_fold_workers(memory, pool)
+
+    scores = {class_name: [None] * len(bounds) for class_name in class_names}
+    for class_name, _, fold, fold_accuracy, _, _, wall_time in results:
+        scores[class_name][fold] = (fold_accuracy, wall_time)
+
+    print("classifier".ljust(22), "mean %".rjust(8), "std %".rjust(8), "  fold times (s)")
+    for class_name in class_names:
+        accuracies = [score[0] for score in scores[class_name]]
+        print(class_name.ljust(22), ("%.2f" % numpy.mean(accuracies)).rjust(8),
+              ("%.2f" % numpy.std(accuracies)).rjust(8), " ",
+              " ".join("%.3f" % score[1] for score in scores[class_name]))
+    return scores
+
+
+def parse_param_values(name, text):
+    """
+    Parses the values given for a parameter on the command line: either a list separated by "|"
+    such as 1|3|5, or a range to sample from such as .01~.5. Layer sizes are separated by "-",
+    e.g. 4-4|8.
+    :param name:
+    :param text:
+    :return: a list of values or a (low, high) tuple
+    """
+    def parse_value(val):
+        if name == "layers":
+            return [int(size) for size in val.split("-") if size]
+        if val.lower() == "none":
+            return None
+        if val.lower() in ("true", "false"):
+            return val.lower() == "true"
+        for convert in (int, float):
+            try:
+                return convert(val)
+            except ValueError:
+                pass
+        return val
+
+    if "~" in text:
+        low, high = text.split("~")
+        return parse_value(low), parse_value(high)
+    return [parse_value(val) for val in text.split("|")]
+
+
+def load_param_file(file_path):
+    """
+    Reads the parameters to search from a json file mapping each parameter to a list of values,
+    or to {"min": low, "max": high} for a range to sample from
+    :param file_path:
+    :return:
+    """
+    with open(file_path, "rt") as param_file:
+        params = json.load(param_file)
+    return {name: (vals["min"], vals["max"]) if isinstance(vals, dict) else list(vals)
+            for name, vals in params.items()}
+
+
+def make_candidates(class_name, params, search, samples, rng):
+    """
+    Returns the settings to try for a classifier, using only the parameters it uses. A grid
+    search tries every combination, a random search tries up to samples distinct combinations,
+    drawing range parameters uniformly (as integers when both ends are integers).
+    :param class_name:
+    :param params:
+    :param search:
+    :param samples:
+    :param rng:
+    :return:
+    """
+    names = [name for name in params if name in CLASSIFIER_SETTINGS[class_name] or name in DATA_SETTINGS]
+    if search == "grid":
+        for name in names:
+            if isinstance(params[name], tuple):
+                raise ValueError("Ranges can only be used by a random search: " + name)
+        return [dict(zip(names, vals)) for vals in itertools.product(*[params[name] for name in names])]
+
+    candidates = {}
+    for attempt in range(samples * 10):
+        if len(candidates) == samples:
+            break
+        candidate = {}
+        for name in names:
+            vals = params[name]
+            if not isinstance(vals, tuple):
+                candidate[name] = vals[rng.integers(len(vals))]
+            elif isinstance(vals[0], int) and isinstance(vals[1], int):
+                candidate[name] = int(rng.integers(vals[0], vals[1] + 1))
+            else:
+                candidate[name] = float(rng.uniform(vals[0], vals[1]))
+        candidates.setdefault(json.dumps(candidate, sort_keys=True), candidate)
+    return list(candidates.values())
+
+
+def group_candidates(class_name, candidates):
+    """
+    Groups KNearestNeighbors candidates which only differ in k so the neighbors are found once for
+    all of them. Every other candidate is in a group of its own.
+    :param class_name:
+    :param candidates: list of (candidate number, settings)
+    :return:
+    """
+    if class_name != "KNearestNeighbors":
+        return [[candidate] for candidate in candidates]
+    groups = {}
+    for number, params in candidates:
+        key = json.dumps({name: val for name, val in params.items() if name != "k"}, sort_keys=True)
+        if "k" not in params:
+            key += str(number)
+        groups.setdefault(key, []).append((number, params))
+    return list(groups.values())
+
+
+def hyperparameter_search(data, class_names, params, search, samples, folds, split, prune, settings, bins,
+                          bin_strategy, norm):
+    """
+    Tries candidate settings for each classifier, scoring each on the rows after the split or with
+    cross validation, and prints them ranked by accuracy. The folds are run one at a time across all
+    remaining candidates, and after each one any candidate whose mean accuracy is more than prune
+    percentage points below the best is dropped.
+    :param data:
+    :param class_names:
+    :param params: map of parameter name to a list of values or a (low, high) range
+    :param search: "grid" or "random"
+    :param samples: number of candidates for a random search
+    :param folds:
+    :param split:
+    :param prune:
+    :param settings:
+    :param bins:
+    :param bin_strategy:
+    :param norm:
+    :return: list of the candidate results, best first
+    """
+    rng = numpy.random.default_rng(settings["seed"])
+    candidates = []
+    for class_name in class_names:
+        for params_tried in make_candidates(class_name, params, search, samples, rng):
+            candidates.append(dict(class_name=class_name, params=params_tried, accuracies=[], train_times=[],
+                                   predict_times=[], pruned=False))
+
+    memory, pool = open_fold_workers(data, settings, bins, bin_strategy, norm)
+    try:
+        for fold, (start, end) in enumerate(fold_bounds(len(data.data_array), folds, split)):
+            tasks = []
+            for class_name in class_names:
+                remaining = [(number, candidate["params"]) for number, candidate in enumerate(candidates)
+                             if candidate["class_name"] == class_name and not candidate["pruned"]]
+                for group in group_candidates(class_name, remaining):
+                    tasks.append((class_name, group, fold, start, end))
+
+            for _, number, _, fold_accuracy, train_time, predict_time, _ in run_fold_tasks(pool, tasks):
+                candidates[number]["accuracies"].append(fold_accuracy)
+                candidates[number]["train_times"].append(train_time)
+                candidates[number]["predict_times"].append(predict_time)
+
+            if prune is not None:
+                remaining = [candidate for candidate in candidates if not candidate["pruned"]]
+                best = max(numpy.mean(candidate["accuracies"]) for candidate in remaining)
+                for candidate in remaining:
+                    candidate["pruned"] = numpy.mean(candidate["accuracies"]) < best - prune
+    finally:
+        close_fold_workers(memory, pool)
+
+    ranked = sorted(candidates, key=lambda candidate: (candidate["pruned"], -numpy.mean(candidate["accuracies"])))
+    print("rank".rjust(4), "classifier".ljust(22), "mean %".rjust(8), "std %".rjust(8), "folds".rjust(6),
+          "train (s)".rjust(10), "predict (s)".rjust(12), "  settings")
+    for rank, candidate in enumerate(ranked):
+        print(str(rank + 1).rjust(4), candidate["class_name"].ljust(22),
+              ("%.2f" % numpy.mean(candidate["accuracies"])).rjust(8),
+              ("%.2f" % numpy.std(candidate["accuracies"])).rjust(8),
+              str(len(candidate["accuracies"])).rjust(6), ("%.3f" % numpy.mean(candidate["train_times"])).rjust(10),
+              ("%.3f" % numpy.mean(candidate["predict_times"])).rjust(12), " ",
+              json.dumps(candidate["params"], sort_keys=True) + (" (pruned)" if candidate["pruned"] else ""))
+    return ranked
+
+
+def print_epoch(epoch, metrics):
+    print("epoch", epoch, " ".join(key + "=" + str(val) for key, val in sorted(metrics.items())))
+
+
+def report_recall(net, data):
+    """
+    Prints how many of the true k nearest neighbors the approximate index found, along with the
+    query time of both. A neighbor counts as found when it is no farther away than the true k-th
+    nearest neighbor, so ties between equally distant rows aren't counted as misses.
+    :param net:
+    :param data:
+    :return:
+    """
+    exact = classifier.KNearestNeighbor(k=net.k)
+    exact.train(data.train_attributes, data.train_targets, data.mapped_columns)
+
+    start = time.perf_counter()
+    approx_distances = net.kneighbors(data.test_attributes)[1]
+    approx_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact_distances = exact.kneighbors(data.test_attributes)[1]
+    exact_time = time.perf_counter() - start
+
+    found = approx_distances <= exact_distances[:, -1:]
+    print("Recall against exact KNN: ", str(found.mean() * 100), "%")
+    print("Query time: approximate ", str(approx_time), "s, exact ", str(exact_time), "s")
 
 if __name__ == "__main__":
     main(sys.argv)